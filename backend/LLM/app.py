@@ -1,9 +1,16 @@
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, Response, stream_with_context, g
 import os
 from dotenv import load_dotenv
-from compare_api import compare_vector
+from compare_api import compare_vector, compare_vectors, add_feature, remove_feature, feature_dim
 import rag_v1
 import json
+import time
+import metrics
+from chat_cache import answer_cache
+from distance_service import routing_requires_api_key, distance_stats
+from ollama_gate import ollama_gate, Overloaded
+from warmup import warmup, WARMUP_ON_START
+from lexical_index import lexical_stats
 
 app = Flask(__name__)
 load_dotenv()
@@ -11,10 +18,34 @@ load_dotenv()
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "a-default-secret-key-for-development")
 GOOGLE_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.get_json()
-    print("收到 /chat 請求，body:", data)
+# 每個 worker 載入 app 時就在背景預熱；/readyz 在全部完成前回 503
+if WARMUP_ON_START:
+    warmup.start()
+
+# /metrics 的量測值：各模組既有的 stats()
+metrics.register_stats("hunter_chat_cache", answer_cache.stats, "Answer cache")
+metrics.register_stats("hunter_ollama_queue", ollama_gate.stats, "Ollama gate")
+metrics.register_stats("hunter_embedding_batch", rag_v1.embedding_scheduler.stats, "Embedding scheduler")
+metrics.register_stats("hunter_self_check_local", rag_v1.response_validator.stats, "Local self-check validator")
+metrics.register_stats("hunter_distance", distance_stats, "Distance lookups")
+metrics.register_stats("hunter_retrieval_lexical", lexical_stats, "Lexical rule lookups")
+metrics.register_stats("hunter_warmup", lambda: {"ready": int(warmup.ready())}, "Startup warm-up")
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_latency(response):
+    # 串流回應在這裡只算到開始送出的時間，完整耗時見 hunter_chat_request_seconds
+    started = g.pop("request_started", None)
+    if started is not None and request.endpoint != "metrics_endpoint":
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started, endpoint=request.endpoint or "unknown", method=request.method, status=response.status_code)
+    return response
+
+def _chat_messages(data):
+    """從 CSR_input.json 格式取出 (message, conversation_history)；缺少 message 時 message 為 None"""
     # 支援 CSR_input.json 格式
     message = data.get("message")
     history = data.get("history", [])
@@ -23,7 +54,7 @@ def chat():
     if not message:
         message = data.get("prompt")
     if not message:
-        return jsonify({"error": "Missing message"}), 400
+        return None, []
 
     # 將 history 轉換為 LLM 需要的格式
     conversation_history = []
@@ -42,12 +73,56 @@ def chat():
         })
     # 加入本次 user 輸入
     conversation_history.append({"role": "user", "content": message})
+    return message, conversation_history
 
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _overloaded_response(e):
+    """Ollama 佇列已滿或等待逾時：快速回 503，請前端依 Retry-After 稍後重試"""
+    response = jsonify({"error": "overloaded", "detail": str(e), "retryAfter": e.retry_after})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+def _chat_stream_response(message, conversation_history, chat_id=None):
+    """以 Server-Sent Events 逐段回傳生成內容，最後送出 final 事件確認或撤回"""
+    events = rag_v1.iter_chat_events(message, conversation_history, stream=True, chat_id=chat_id)
+    # 先取出第一個事件，排隊失敗時還能回 503 而不是已開始的串流
     try:
-        # 呼叫 rag_v1 處理
-        response_text = rag_v1.handle_chat_request(message, conversation_history)
+        first = next(events)
+    except Overloaded as e:
+        return _overloaded_response(e)
+
+    def generate():
+        yield _sse(*first)
+        for event, data in events:
+            yield _sse(event, data)
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    data = request.get_json()
+    print("收到 /chat 請求，body:", data)
+    message, conversation_history = _chat_messages(data)
+    if not message:
+        return jsonify({"error": "Missing message"}), 400
+
+    # 前端要求 text/event-stream 時改用串流回覆；預設維持 {reply} JSON
+    if request.accept_mimetypes.best == "text/event-stream":
+        return _chat_stream_response(message, conversation_history, data.get("chatId"))
+
+    try:
+        # 呼叫 rag_v1 處理；chatId 用來維護該 session 的滾動摘要
+        response_text = rag_v1.handle_chat_request(message, conversation_history, chat_id=data.get("chatId"))
         # 回傳 CSR_output.json 格式
         return jsonify({"reply": response_text})
+    except Overloaded as e:
+        return _overloaded_response(e)
     except Exception as e:
         import traceback
         print("Error in /chat:", e)
@@ -55,6 +130,14 @@ def chat():
         print("請求內容:", data)
         return jsonify({"error": str(e)}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    data = request.get_json()
+    message, conversation_history = _chat_messages(data)
+    if not message:
+        return jsonify({"error": "Missing message"}), 400
+    return _chat_stream_response(message, conversation_history, data.get("chatId"))
+
 @app.route('/route', methods=['POST'])
 def route():
     data = request.get_json()
@@ -64,16 +147,17 @@ def route():
     user_location = data.get("userLocation")
     candidate_landmarks = data.get("candidateLandmarks")
     enable_self_check = data.get("enable_self_check", True) # 允許前端控制是否開啟
+    stops = data.get("stops") # 選填：指定任務地點數
 
     if not user_location or not candidate_landmarks:
         return jsonify({"error": "Missing userLocation or candidateLandmarks"}), 400
 
-    if not GOOGLE_API_KEY:
+    if not GOOGLE_API_KEY and routing_requires_api_key():
         return jsonify({"error": "Missing GOOGLE_MAPS_API_KEY in environment"}), 500
 
     try:
         # 呼叫 rag_v1 中的路線處理函式
-        mission_result = rag_v1.handle_route_request(user_location, candidate_landmarks, enable_self_check, GOOGLE_API_KEY)
+        mission_result = rag_v1.handle_route_request(user_location, candidate_landmarks, enable_self_check, GOOGLE_API_KEY, stops)
         return jsonify(mission_result)
     except Exception as e:
         print("Error in /route:", e)  # 印出詳細錯誤訊息
@@ -85,9 +169,24 @@ def healthz():
     return jsonify({
         "status": "ok",
         "service": "hunter-llm",
-        "port": int(os.getenv("PORT", "5050"))
+        "port": int(os.getenv("PORT", "5050")),
+        "chat_cache": answer_cache.stats(),
+        "ollama_queue": ollama_gate.stats(),
+        "embedding_batches": rag_v1.embedding_scheduler.stats(),
+        "self_check": rag_v1.response_validator.stats(),
+        "lexical_retrieval": lexical_stats()
     }), 200
 
+@app.get("/readyz")
+def readyz():
+    # 就緒探針：規則索引、特徵快取、路網與模型都預熱完成才回 200
+    ready = warmup.ready()
+    return jsonify({"status": "ready" if ready else "warming", "warmup": warmup.status()}), 200 if ready else 503
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 
 # 特徵比對
 @app.route("/compare", methods=["POST"])
@@ -103,6 +202,57 @@ def compare():
     except Exception as e:
         return jsonify({"error": "compare_failed", "detail": str(e)}), 500
 
+# 批次特徵比對：{"items": [{"spotName": ..., "vector": [...]}, ...]}
+@app.route("/compare/batch", methods=["POST"])
+def compare_batch():
+    data = request.get_json(force=True)
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "invalid body"}), 400
+    try:
+        dim = feature_dim()
+    except Exception as e:
+        return jsonify({"error": "compare_failed", "detail": str(e)}), 500
+    pairs = []
+    for i, item in enumerate(items):
+        spotName = item.get("spotName") if isinstance(item, dict) else None
+        vector = item.get("vector") if isinstance(item, dict) else None
+        # 維度不符的向量會讓整批比對失敗，先指出是哪一筆
+        if not isinstance(spotName, str) or not isinstance(vector, list) or len(vector) != dim:
+            return jsonify({"error": "invalid body", "index": i}), 400
+        pairs.append((spotName, vector))
+    try:
+        results = compare_vectors(pairs)
+        return jsonify({"results": results})
+    except Exception as e:
+        return jsonify({"error": "compare_failed", "detail": str(e)}), 500
+
+# 線上新增地標特徵：{"label": ..., "vector": [...], "filePath": 選填}
+@app.route("/features", methods=["POST"])
+def create_feature():
+    data = request.get_json(force=True)
+    label = data.get("label") if isinstance(data, dict) else None
+    vector = data.get("vector") if isinstance(data, dict) else None
+    if not isinstance(label, str) or not label or not isinstance(vector, list):
+        return jsonify({"error": "invalid body"}), 400
+    try:
+        row_id = add_feature(label, vector, data.get("filePath"))
+        return jsonify({"id": row_id, "label": label}), 201
+    except ValueError as e:
+        return jsonify({"error": "invalid body", "detail": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": "feature_update_failed", "detail": str(e)}), 500
+
+# 線上刪除地標特徵
+@app.route("/features/<int:feature_id>", methods=["DELETE"])
+def delete_feature(feature_id):
+    try:
+        if not remove_feature(feature_id):
+            return jsonify({"error": "not_found"}), 404
+        return jsonify({"deleted": feature_id}), 200
+    except Exception as e:
+        return jsonify({"error": "feature_update_failed", "detail": str(e)}), 500
+
 if __name__ == '__main__':
     # try:
     #     with open("js_to_py.json", "r", encoding="utf-8") as f:
@@ -118,5 +268,6 @@ if __name__ == '__main__':
     #     print("js_to_py.json not found, skipping /route test.")
     # except Exception as e:
     #     print(f"An error occurred during /route test request: {e}")
+    # 開發用；正式環境請用 gunicorn -c gunicorn.conf.py app:app
     port = int(os.getenv("PORT", "5050"))  # Render/容器會注入 PORT
-    app.run(host="0.0.0.0", port=port, debug=True, use_reloader=False)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=port, debug=os.getenv("FLASK_DEBUG") == "1", use_reloader=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1 @@
+# bench：效能與回歸測試工具（模擬 Ollama／Directions 伺服器、合成特徵、負載情境）。在 backend/LLM 下以 python -m bench.<模組> 執行。
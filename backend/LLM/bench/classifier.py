@@ -0,0 +1,66 @@
+# bench/classifier.py
+# 比較本地分類（規則 + 範例句最近鄰）與 LLM classify_question_type 在標註樣本上的混淆矩陣。
+#
+# 用法（在 backend/LLM 下執行）：
+#   python -m bench.classifier                       # 規則 + 範例句 + LLM（需要 Ollama）
+#   python -m bench.classifier --no-llm --no-exemplars  # 只測關鍵字規則，不需要 Ollama
+import argparse
+import json
+from collections import Counter
+from llm_utils import local_classify_question, classify_by_exemplars, classify_question_type, embed
+
+QUESTION_TYPES = ["greeting", "mission_request", "rule_query", "off_topic", "other"]
+# 本地分類沒把握時記為 unsure
+LOCAL_TYPES = QUESTION_TYPES + ["unsure"]
+_INTENT_TO_TYPE = {"greeting": "greeting", "thanks": "greeting", "off_topic": "off_topic", "language": "off_topic"}
+
+
+def confusion(pairs, columns):
+    counts = Counter(pairs)
+    return {label: {col: counts[(label, col)] for col in columns} for label in QUESTION_TYPES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地分類 vs LLM 分類混淆報告")
+    parser.add_argument("--samples", default="assets/question_samples.json")
+    parser.add_argument("--no-llm", action="store_true", help="不呼叫 LLM 分類")
+    parser.add_argument("--no-exemplars", action="store_true", help="不使用範例句最近鄰（不呼叫 embedding）")
+    args = parser.parse_args()
+
+    with open(args.samples, encoding="utf-8") as f:
+        samples = json.load(f)
+
+    local_pairs, llm_pairs, disagreements = [], [], []
+    for sample in samples:
+        text, label = sample["text"], sample["label"]
+        intent = local_classify_question(text)
+        if intent is None and not args.no_exemplars:
+            intent = classify_by_exemplars(embed(text))
+        local_type = _INTENT_TO_TYPE.get(intent, "unsure")
+        local_pairs.append((label, local_type))
+        if not args.no_llm:
+            llm_type = classify_question_type(text)
+            llm_pairs.append((label, llm_type))
+            if local_type != "unsure" and local_type != llm_type:
+                disagreements.append({"text": text, "label": label, "local": local_type, "llm": llm_type})
+
+    decided = [(label, t) for label, t in local_pairs if t != "unsure"]
+    report = {
+        "samples": len(samples),
+        "local": {
+            "coverage": len(decided) / len(samples),
+            "precision": (sum(label == t for label, t in decided) / len(decided)) if decided else 0.0,
+            "confusion": confusion(local_pairs, LOCAL_TYPES),
+        },
+    }
+    if llm_pairs:
+        report["llm"] = {
+            "accuracy": sum(label == t for label, t in llm_pairs) / len(llm_pairs),
+            "confusion": confusion(llm_pairs, QUESTION_TYPES),
+        }
+        report["local_vs_llm_disagreements"] = disagreements
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
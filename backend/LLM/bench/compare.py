@@ -0,0 +1,106 @@
+# bench/compare.py
+# 比對 /compare 各種索引設定、儲存格式與 float32 逐筆比對（brute）的一致率、記憶體與延遲，
+# 用來挑選 FEATURE_INDEX_SHORTLIST 與 FEATURE_STORAGE。
+#
+# 用法（在 backend/LLM 下執行）：
+#   python -m bench.compare --db data/train_features.db --shortlist 2 3 5 --prototypes 1 4
+#   python -m bench.compare --storage float16 int8 --shortlist
+#   python -m bench.compare --scale 100000   # 以現有特徵加雜訊擴充到 10 萬筆再測
+import argparse
+import json
+import time
+import numpy as np
+import compare_api
+from compare_api import load_features_from_database, _l2_normalize, _build_class_index, _quantize, _top2, _decide
+from bench.features import augment, make_queries
+
+
+def make_cache(F: np.ndarray, labels, storage: str = "float32"):
+    """直接由特徵矩陣建立與 ensure_cache 相同格式的快取（不寫快照）"""
+    class_names, _, order, class_starts = _build_class_index(labels)
+    matrix, row_scale = _quantize(_l2_normalize(F, axis=1)[order], storage)
+    return {
+        "signature": "bench",
+        "features_norm": matrix,
+        "row_scale": row_scale,
+        "row_ids": np.arange(F.shape[0], dtype=np.int64)[order],
+        "class_names": class_names,
+        "class_starts": class_starts,
+        "delta": None,
+        "deleted": np.empty(0, dtype=np.int64),
+    }
+
+
+def run(cache, Q, spot_names, shortlist, prototypes, batch):
+    """回傳 (每筆查詢的最佳類別, 每筆查詢的 predicted, 每筆延遲 ms)"""
+    # 先建好原型，建索引的時間不計入查詢延遲
+    if shortlist:
+        compare_api._ensure_prototypes(cache, prototypes)
+    best, predicted, latency = [], [], []
+    for start in range(0, Q.shape[0], batch):
+        t = time.perf_counter()
+        class_best = compare_api.class_max_similarities(Q[start:start + batch], cache, shortlist, prototypes)
+        elapsed = (time.perf_counter() - t) * 1000 / class_best.shape[0]
+        for i, row in enumerate(class_best):
+            best.append(_top2(row)[0])
+            predicted.append(_decide(spot_names[start + i], row, cache["class_names"])["predicted"])
+            latency.append(elapsed)
+    return best, predicted, latency
+
+
+def memory_bytes(cache):
+    scale = cache["row_scale"]
+    return int(cache["features_norm"].nbytes + (scale.nbytes if scale is not None else 0))
+
+
+def summarize(name, cache, base, result):
+    best, predicted, latency = result
+    return {
+        "mode": name,
+        "memory_bytes": memory_bytes(cache),
+        "top1_recall": float(np.mean(np.asarray(best) == np.asarray(base[0]))),
+        "predicted_agreement": float(np.mean(np.asarray(predicted) == np.asarray(base[1]))),
+        "latency_ms_p50": float(np.percentile(latency, 50)),
+        "latency_ms_p95": float(np.percentile(latency, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比對索引召回率／延遲報告")
+    parser.add_argument("--db", default=compare_api.FEATURE_DB_PATH)
+    parser.add_argument("--scale", type=int, default=0, help="擴充特徵到指定筆數（0 為不擴充）")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.3, help="查詢雜訊（相對於特徵標準差）")
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--shortlist", type=int, nargs="*", default=[2, 3, 5])
+    parser.add_argument("--prototypes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--storage", nargs="*", default=["float16", "int8"], help="與 float32 比較的精簡格式")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    _, labels, F = load_features_from_database(args.db)
+    F, labels = augment(np.array(F), labels, args.scale, args.noise, rng)
+    cache = make_cache(F, labels)
+    Q, spot_names = make_queries(F, labels, args.queries, args.noise, rng)
+
+    base = run(cache, Q, spot_names, 0, 1, args.batch)
+    report = {
+        "features": int(F.shape[0]),
+        "classes": len(cache["class_names"]),
+        "queries": int(Q.shape[0]),
+        "results": [summarize("brute", cache, base, base)],
+    }
+    for k in args.prototypes:
+        for c in args.shortlist:
+            result = run(cache, Q, spot_names, c, k, args.batch)
+            report["results"].append(summarize(f"prototype(k={k}, C={c})", cache, base, result))
+    for storage in args.storage:
+        compact = make_cache(F, labels, storage)
+        result = run(compact, Q, spot_names, 0, 1, args.batch)
+        report["results"].append(summarize(f"brute[{storage}]", compact, base, result))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# bench/embeddings.py
+# 比較「每個呼叫者各自呼叫單筆 /api/embeddings」與「經 EmbeddingScheduler 合併成批次 /api/embed」的吞吐量與延遲。
+# 使用 bench.stub_ollama：一次只處理一個請求（模擬單一本機模型），每個請求耗時 = 固定開銷 + 每筆文字的成本。
+#
+# 用法（在 backend/LLM 下執行）：
+#   python -m bench.embeddings --callers 32 --requests 256
+#   python -m bench.embeddings --overhead-ms 40 --per-item-ms 2 --max-batch 16 --max-wait-ms 2 5 10
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import ollama
+from embedding_scheduler import EmbeddingScheduler
+from bench.stub_ollama import StubOllama
+
+
+def run_load(call, callers, requests):
+    """callers 個執行緒同時送出共 requests 筆請求，回傳 (總秒數, 各筆延遲 ms)"""
+    latency = []
+    lock = threading.Lock()
+
+    def one(i):
+        t = time.perf_counter()
+        call(f"第 {i} 個問題：鑰匙要怎麼獲得？")
+        with lock:
+            latency.append((time.perf_counter() - t) * 1000)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=callers) as pool:
+        list(pool.map(one, range(requests)))
+    return time.perf_counter() - started, latency
+
+
+def summarize(name, elapsed, latency, requests, extra=None):
+    return {
+        "mode": name,
+        "requests_per_second": requests / elapsed,
+        "latency_ms_p50": float(np.percentile(latency, 50)),
+        "latency_ms_p95": float(np.percentile(latency, 95)),
+        **(extra or {}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="embedding 微批次吞吐量報告")
+    parser.add_argument("--callers", type=int, default=32, help="同時呼叫的執行緒數")
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--overhead-ms", type=float, default=30, help="模擬伺服器每個請求的固定開銷")
+    parser.add_argument("--per-item-ms", type=float, default=1, help="模擬伺服器每筆文字的成本")
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, nargs="+", default=[2, 5])
+    args = parser.parse_args()
+
+    stub = StubOllama(embed_overhead_ms=args.overhead_ms, embed_per_item_ms=args.per_item_ms)
+    host = stub.start()
+    client = ollama.Client(host=host)
+    model = "stub"
+
+    report = {"callers": args.callers, "requests": args.requests, "results": []}
+    elapsed, latency = run_load(lambda t: client.embeddings(model=model, prompt=t)["embedding"], args.callers, args.requests)
+    report["results"].append(summarize("single", elapsed, latency, args.requests))
+
+    for wait in args.max_wait_ms:
+        scheduler = EmbeddingScheduler(
+            lambda texts: client.embed(model=model, input=texts)["embeddings"], args.max_batch, wait
+        )
+        elapsed, latency = run_load(scheduler.embed, args.callers, args.requests)
+        stats = scheduler.stats()
+        report["results"].append(summarize(
+            f"scheduler(max_batch={args.max_batch}, max_wait_ms={wait})", elapsed, latency, args.requests,
+            {"batches": stats["batches"], "avg_batch": stats["avg_batch"]},
+        ))
+    stub.stop()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# bench/features.py
+# 以 train_features.db 為基礎產生合成特徵：依現有樣本加高斯雜訊擴充資料庫、產生查詢向量，
+# 也可寫成與原資料庫相同結構的 SQLite 檔，讓 /compare 在任意規模下測試。
+import os
+import sqlite3
+import numpy as np
+
+
+def read_feature_db(path):
+    """讀取特徵資料庫，回傳 (labels, 特徵矩陣)；不經過 compare_api，以免它在設定環境變數前就被 import"""
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT label, feature FROM features ORDER BY id").fetchall()
+    conn.close()
+    labels, blobs = zip(*rows)
+    return list(labels), np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), -1)
+
+
+def augment(F: np.ndarray, labels, target: int, noise: float, rng):
+    """以現有樣本加高斯雜訊擴充到 target 筆，模擬每個地標有大量照片"""
+    if target <= F.shape[0]:
+        return F, labels
+    idx = rng.integers(0, F.shape[0], target - F.shape[0])
+    extra = F[idx] + rng.normal(0, noise, (idx.shape[0], F.shape[1])).astype(np.float32) * F.std()
+    return np.concatenate([F, extra], axis=0), list(labels) + [labels[i] for i in idx]
+
+
+def make_queries(F: np.ndarray, labels, n: int, noise: float, rng):
+    """從現有樣本加雜訊產生 n 筆查詢，回傳 (查詢矩陣, 每筆的真實地標)"""
+    idx = rng.integers(0, F.shape[0], n)
+    Q = F[idx] + rng.normal(0, noise, (n, F.shape[1])).astype(np.float32) * F.std()
+    return Q, [labels[i] for i in idx]
+
+
+def write_feature_db(path, F: np.ndarray, labels):
+    """寫出與 train_features.db 相同結構的資料庫"""
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE features (id INTEGER PRIMARY KEY AUTOINCREMENT, file_path TEXT, label TEXT, feature BLOB)")
+    conn.executemany(
+        "INSERT INTO features (file_path, label, feature) VALUES (?, ?, ?)",
+        ((f"synthetic/{i}.jpg", label, np.asarray(row, dtype=np.float32).tobytes())
+         for i, (label, row) in enumerate(zip(labels, F))),
+    )
+    conn.commit()
+    conn.close()
+    return path
@@ -0,0 +1,207 @@
+# bench/load.py
+# 端到端負載測試：啟動模擬 Ollama 與 Directions 伺服器、以合成特徵建立特徵資料庫，
+# 在本機啟動 Flask app，依指定併發數打 /chat、/route、/compare 或混合流量，
+# 輸出 p50/p95/p99 延遲、每秒請求數與每個請求的 LLM 呼叫數（JSON），用來比較熱路徑修改前後的差異。
+#
+# 用法（在 backend/LLM 下執行）：
+#   python -m bench.load --scenarios chat route compare mixed --concurrency 1 8 32 --requests 200
+#   python -m bench.load --scenarios chat --chat-ms 500 --audit-fail-rate 0.3 --repeat-rate 0
+#   python -m bench.load --scenarios compare --features 100000 --out before.json
+import argparse
+import contextlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from bench.stub_ollama import StubOllama
+from bench.stub_directions import StubDirections
+from bench.features import read_feature_db, augment, make_queries, write_feature_db
+
+SCENARIOS = ("chat", "route", "compare", "mixed")
+
+
+def parse_mix(text):
+    """"chat=0.5,route=0.2,compare=0.3" -> [(名稱, 權重)]"""
+    pairs = [item.split("=") for item in text.split(",") if item]
+    return [(name.strip(), float(weight)) for name, weight in pairs]
+
+
+class Workload:
+    """產生各情境的請求內容（路徑, JSON body）"""
+
+    def __init__(self, args, queries, spot_names, rng):
+        with open("assets/question_samples.json", encoding="utf-8") as f:
+            self.questions = [s["text"] for s in json.load(f)]
+        with open("assets/route_input.json", encoding="utf-8") as f:
+            self.route_input = json.load(f)
+        self.queries = queries
+        self.spot_names = spot_names
+        self.repeat_rate = args.repeat_rate
+        self.mix = parse_mix(args.mix)
+        self.rng = rng
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def _next_id(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def chat(self):
+        i = self._next_id()
+        with self.lock:
+            question = self.rng.choice(self.questions)
+            repeat = self.rng.random() < self.repeat_rate
+        # 不重複的問題加上編號，避開回答快取
+        message = question if repeat else f"{question}（第{i}題）"
+        return "/chat", {"message": message, "history": [], "chatId": f"bench-{i % 50}"}
+
+    def route(self):
+        body = json.loads(json.dumps(self.route_input))
+        with self.lock:
+            body["userLocation"]["latitude"] += self.rng.uniform(-0.002, 0.002)
+            body["userLocation"]["longitude"] += self.rng.uniform(-0.002, 0.002)
+        body["enable_self_check"] = False
+        return "/route", body
+
+    def compare(self):
+        i = self._next_id() % len(self.queries)
+        return "/compare", {"spotName": self.spot_names[i], "vector": self.queries[i].tolist()}
+
+    def mixed(self):
+        with self.lock:
+            name = self.rng.choices([n for n, _ in self.mix], weights=[w for _, w in self.mix], k=1)[0]
+        return getattr(self, name)()
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def run_level(base_url, workload, scenario, concurrency, total):
+    local = threading.local()
+    latency, statuses = [], {}
+    lock = threading.Lock()
+
+    def one(_):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        path, body = getattr(workload, scenario)()
+        started = time.perf_counter()
+        try:
+            status = session.post(base_url + path, json=body, timeout=300).status_code
+        except requests.RequestException:
+            status = "error"
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latency.append(elapsed)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    return time.perf_counter() - started, latency, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/chat、/route、/compare 混合負載報告")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=100, help="每個情境、每個併發數的請求數")
+    parser.add_argument("--mix", default="chat=0.4,route=0.2,compare=0.4", help="mixed 情境的流量比例")
+    parser.add_argument("--repeat-rate", type=float, default=0.3, help="chat 問題重複（可命中回答快取）的比例")
+    parser.add_argument("--chat-ms", type=float, default=200, help="模擬 Ollama 每次 chat 的延遲")
+    parser.add_argument("--embed-ms", type=float, default=30, help="模擬 Ollama 每次 embedding 的固定延遲")
+    parser.add_argument("--audit-fail-rate", type=float, default=0.0, help="LLM 自我檢查判定不合格的機率")
+    parser.add_argument("--directions-ms", type=float, default=80, help="模擬 Directions API 的延遲")
+    parser.add_argument("--db", default="data/train_features.db", help="合成特徵的來源資料庫")
+    parser.add_argument("--features", type=int, default=0, help="把特徵資料庫擴充到指定筆數（0 為不擴充）")
+    parser.add_argument("--noise", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="另存報告的路徑")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    workdir = tempfile.mkdtemp(prefix="hunter-bench-")
+
+    ollama_stub = StubOllama(chat_ms=args.chat_ms, embed_overhead_ms=args.embed_ms,
+                             audit_fail_rate=args.audit_fail_rate, seed=args.seed)
+    directions_stub = StubDirections(latency_ms=args.directions_ms)
+
+    # compare_api 讀取的是資料庫檔案；先寫一份合成特徵到暫存目錄
+    labels, F = read_feature_db(args.db)
+    F, labels = augment(np.array(F), labels, args.features, args.noise, rng)
+    feature_db = write_feature_db(os.path.join(workdir, "features.db"), F, labels)
+    queries, spot_names = make_queries(F, labels, 1000, args.noise, rng)
+
+    # 各模組在 import 時讀環境變數，必須在 import app 之前設定
+    os.environ.update({
+        "OLLAMA_HOST": ollama_stub.start(),
+        "GOOGLE_DIRECTIONS_URL": directions_stub.start(),
+        "GOOGLE_MAPS_API_KEY": os.getenv("GOOGLE_MAPS_API_KEY", "bench"),
+        "FEATURE_DB_PATH": feature_db,
+        "FEATURE_SNAPSHOT_DIR": os.path.join(workdir, "snapshots"),
+        "DISTANCE_CACHE_DB": os.path.join(workdir, "distances.db"),
+        "EMBEDDING_CACHE_DIR": os.path.join(workdir, "embeddings"),
+        "CHAT_SUMMARY_DB": "",
+        "CHAT_CACHE_DB": "",
+    })
+    from werkzeug.serving import make_server
+    import app as flask_app
+
+    server = make_server("127.0.0.1", 0, flask_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    workload = Workload(args, queries, spot_names, random.Random(args.seed))
+
+    # 等 app 背景預熱（規則索引、特徵快取、模型預載）完成
+    while requests.get(base_url + "/readyz", timeout=5).status_code != 200:
+        time.sleep(0.2)
+
+    # app 內的 print 會混進報告；測試期間把 stdout 導到 /dev/null
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        # 先各打一次，不計入結果
+        for scenario in ("chat", "compare"):
+            run_level(base_url, workload, scenario, 1, 1)
+
+        report = {
+            "config": {k: v for k, v in vars(args).items() if k != "out"},
+            "features": int(F.shape[0]),
+            "results": [],
+        }
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                llm_before, directions_before = ollama_stub.llm_calls(), directions_stub.calls
+                elapsed, latency, statuses = run_level(base_url, workload, scenario, concurrency, args.requests)
+                report["results"].append({
+                    "scenario": scenario,
+                    "concurrency": concurrency,
+                    "requests": args.requests,
+                    "requests_per_second": args.requests / elapsed,
+                    "latency_ms_p50": percentile(latency, 50),
+                    "latency_ms_p95": percentile(latency, 95),
+                    "latency_ms_p99": percentile(latency, 99),
+                    "llm_calls_per_request": (ollama_stub.llm_calls() - llm_before) / args.requests,
+                    "directions_calls_per_request": (directions_stub.calls - directions_before) / args.requests,
+                    "status": statuses,
+                })
+    report["llm_calls_by_role"] = dict(ollama_stub.calls)
+
+    server.shutdown()
+    ollama_stub.stop()
+    directions_stub.stop()
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
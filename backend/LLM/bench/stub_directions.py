@@ -0,0 +1,65 @@
+# bench/stub_directions.py
+# 模擬 Google Directions API：依起訖點直線距離 × 繞行係數回傳步行距離與時間，延遲可設定，並統計呼叫次數。
+import json
+import math
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+def _meters(lat1, lon1, lat2, lon2):
+    r = 6371000.0
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * r * math.asin(math.sqrt(a))
+
+
+class StubDirections:
+    def __init__(self, latency_ms=80, detour=1.25, speed_mps=1.35, status="OK"):
+        self.latency_ms = latency_ms
+        self.detour = detour
+        self.speed_mps = speed_mps
+        # 設成 REQUEST_DENIED 等值可模擬 API 故障
+        self.status = status
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.server = None
+
+    def handle(self, query):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency_ms / 1000)
+        if self.status != "OK":
+            return {"status": self.status, "routes": []}
+        (lat1, lon1), (lat2, lon2) = [map(float, query[k][0].split(",")) for k in ("origin", "destination")]
+        distance = int(round(_meters(lat1, lon1, lat2, lon2) * self.detour))
+        leg = {"distance": {"value": distance}, "duration": {"value": int(round(distance / self.speed_mps))}}
+        return {"status": "OK", "routes": [{"legs": [leg]}]}
+
+    def start(self, port=0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                data = json.dumps(stub.handle(parse_qs(urlparse(self.path).query))).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}/maps/api/directions/json"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,147 @@
+# bench/stub_ollama.py
+# 模擬 Ollama 的 HTTP 伺服器：/api/chat（含串流）、/api/embed、/api/embeddings、/api/generate、/api/tags。
+# 依 prompt 內容回傳固定輸出（分類、自我檢查、摘要、生成），延遲可設定；
+# 預設一次只處理一個模型請求，模擬單一本機模型，並統計各角色的呼叫次數。
+# 回覆內容與向量和 llm_client 的行程內 stub 後端相同
+import json
+import time
+import random
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from llm_client import STUB_REPLIES, stub_vector as _vector
+
+DEFAULT_REPLY = STUB_REPLIES["generate"]
+
+
+def classify_role(content):
+    """依 prompt 判斷是哪一種 LLM 呼叫"""
+    if "屬於以下哪一類型" in content:
+        return "classify"
+    if "=== 回覆內容開始 ===" in content:
+        return "audit"
+    if "請總結" in content:
+        return "summary"
+    if "遊戲內問題" in content:
+        return "relevance"
+    return "generate"
+
+
+class StubOllama:
+    """
+    chat_ms：每次 chat 的延遲；embed_overhead_ms + embed_per_item_ms × 筆數：每次 embedding 的延遲。
+    audit_fail_rate：自我檢查判定不合格的機率，用來模擬重試。
+    """
+
+    def __init__(self, chat_ms=200, embed_overhead_ms=30, embed_per_item_ms=1, audit_fail_rate=0.0,
+                 reply=DEFAULT_REPLY, dim=64, serialize=True, seed=0):
+        self.chat_ms = chat_ms
+        self.embed_overhead_ms = embed_overhead_ms
+        self.embed_per_item_ms = embed_per_item_ms
+        self.audit_fail_rate = audit_fail_rate
+        self.reply = reply
+        self.dim = dim
+        self.calls = Counter()
+        self._rng = random.Random(seed)
+        self._model_lock = threading.Lock() if serialize else None
+        self._stats_lock = threading.Lock()
+        self.server = None
+
+    def _busy(self, ms):
+        if self._model_lock is None:
+            time.sleep(ms / 1000)
+            return
+        with self._model_lock:
+            time.sleep(ms / 1000)
+
+    def _count(self, role, n=1):
+        with self._stats_lock:
+            self.calls[role] += n
+
+    def llm_calls(self):
+        """目前為止的模型呼叫總數（embedding 批次算一次）"""
+        with self._stats_lock:
+            return sum(self.calls.values())
+
+    def chat_output(self, role):
+        if role == "audit":
+            with self._stats_lock:
+                failed = self._rng.random() < self.audit_fail_rate
+            return "不合格：僅根據明確提及的規則段落回答" if failed else STUB_REPLIES["audit"]
+        if role == "generate":
+            return self.reply
+        return STUB_REPLIES[role]
+
+    def handle(self, path, body):
+        """回傳 (JSON 物件或串流片段 list, 是否串流)"""
+        stats = {"prompt_eval_count": 64, "eval_count": 16, "eval_duration": int(self.chat_ms * 1e6),
+                 "prompt_eval_duration": 1_000_000, "load_duration": 0, "done": True}
+        if path == "/api/chat":
+            role = classify_role(body["messages"][-1]["content"])
+            self._count(role)
+            self._busy(self.chat_ms)
+            content = self.chat_output(role)
+            if body.get("stream", True):
+                chunks = [{"model": body.get("model"), "message": {"role": "assistant", "content": ch}, "done": False}
+                          for ch in content]
+                chunks.append({"model": body.get("model"), "message": {"role": "assistant", "content": ""}, **stats})
+                return chunks, True
+            return {"model": body.get("model"), "message": {"role": "assistant", "content": content}, **stats}, False
+        if path == "/api/embed":
+            texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            self._count("embed")
+            self._busy(self.embed_overhead_ms + self.embed_per_item_ms * len(texts))
+            return {"model": body.get("model"), "embeddings": [_vector(t, self.dim) for t in texts]}, False
+        if path == "/api/embeddings":
+            self._count("embed")
+            self._busy(self.embed_overhead_ms + self.embed_per_item_ms)
+            return {"embedding": _vector(body["prompt"], self.dim)}, False
+        if path == "/api/generate":
+            # 預載模型（keep_alive）用；prompt 為空時不計入生成
+            self._count("preload" if not body.get("prompt") else "generate")
+            return {"model": body.get("model"), "response": "", "done": True}, False
+        return None, False
+
+    def start(self, port=0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, payload, content_type="application/json"):
+                data = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._send(200, {"models": []})
+                else:
+                    self._send(404, {"error": "not found"})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                payload, streaming = stub.handle(self.path, body)
+                if payload is None:
+                    self._send(404, {"error": "not found"})
+                elif streaming:
+                    lines = "".join(json.dumps(c, ensure_ascii=False) + "\n" for c in payload).encode("utf-8")
+                    self._send(200, lines, "application/x-ndjson")
+                else:
+                    self._send(200, payload)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,181 @@
+# chat_cache.py
+# /chat 回答快取：同一個問題（正規化後）在規則未變動時直接回傳已通過自我檢查的答案，不再呼叫 LLM。
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "512"))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "86400"))
+# 設定後啟用 SQLite 持久層，重啟後仍可命中；留空則只用記憶體
+CHAT_CACHE_DB = os.getenv("CHAT_CACHE_DB", "")
+
+_PUNCT = re.compile(r"[\s\?？!！。．\.,，、~～…]+")
+
+def normalize_message(text: str) -> str:
+    """全形半形統一、轉小寫並去掉空白與標點，讓「鑰匙怎麼獲得？」與「鑰匙怎麼獲得」視為同一題"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return _PUNCT.sub("", text)
+
+def cache_message_key(message: str, context: str = "") -> str:
+    """快取用的問題鍵；有上下文（對話歷史、摘要）時附上其指紋，不同對話脈絡下的同一句話不會共用答案"""
+    key = normalize_message(message)
+    return f"{key}#{context}" if context else key
+
+_VERSION_CACHE = {}
+
+def file_version(path: str) -> str:
+    """檔案內容的雜湊；以 mtime/size 判斷是否需要重算"""
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _VERSION_CACHE.get(path)
+    if cached is None or cached[0] != stamp:
+        with open(path, "rb") as f:
+            cached = (stamp, hashlib.sha1(f.read()).hexdigest())
+        _VERSION_CACHE[path] = cached
+    return cached[1]
+
+class AnswerCache:
+    """
+    LRU + TTL 的回答快取。
+    完整鍵為（規則版本、問題鍵、問題分類、檢索段落 id），另以（規則版本、問題鍵）建索引，
+    讓請求一進來、還沒分類與 embedding 前就能查到答案。
+    問題鍵是正規化後的問題加上上下文指紋（見 cache_message_key），沒有上下文的問題才會跨 session 共用。
+    """
+
+    def __init__(self, max_entries=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL, db_path=CHAT_CACHE_DB):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = OrderedDict()   # 完整鍵 -> entry
+        self._by_message = {}           # (版本, 正規化問題) -> 完整鍵
+        self._version = None
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+        if db_path:
+            self._init_db()
+
+    def _init_db(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key TEXT PRIMARY KEY, message_key TEXT, version TEXT, question_type TEXT, "
+                "paragraph_ids TEXT, answer TEXT, created REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS answers_message ON answers (message_key, version)")
+
+    @staticmethod
+    def _full_key(version, message_key, question_type, paragraph_ids):
+        raw = json.dumps([version, message_key, question_type, list(paragraph_ids)], ensure_ascii=False)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _check_version(self, version):
+        """規則版本改變時清空記憶體層並刪掉持久層的舊資料"""
+        if version == self._version:
+            return
+        if self._version is not None:
+            self._entries.clear()
+            self._by_message.clear()
+            self._stats["invalidations"] += 1
+            if self.db_path:
+                with sqlite3.connect(self.db_path) as conn:
+                    conn.execute("DELETE FROM answers WHERE version != ?", (version,))
+        self._version = version
+
+    def _load_from_db(self, message_key, version):
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT key, question_type, paragraph_ids, answer, created FROM answers "
+                "WHERE message_key = ? AND version = ? ORDER BY created DESC LIMIT 1",
+                (message_key, version),
+            ).fetchone()
+        if row is None:
+            return None, None
+        key, question_type, paragraph_ids, answer, created = row
+        entry = {"question_type": question_type, "paragraph_ids": json.loads(paragraph_ids), "answer": answer, "created": created}
+        return key, entry
+
+    def _put(self, key, message_key, entry):
+        # 同一題換了分類或檢索段落時，以新答案取代舊答案
+        previous = self._by_message.get((self._version, message_key))
+        if previous is not None and previous != key:
+            self._entries.pop(previous, None)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._by_message[(self._version, message_key)] = key
+        while len(self._entries) > self.max_entries:
+            old_key, old = self._entries.popitem(last=False)
+            if self._by_message.get((self._version, old["message_key"])) == old_key:
+                del self._by_message[(self._version, old["message_key"])]
+            self._stats["evictions"] += 1
+
+    def lookup(self, message, version, context=""):
+        """以問題與上下文指紋查詢快取；命中時回傳 entry（含 answer、question_type、paragraph_ids），否則 None"""
+        message_key = cache_message_key(message, context)
+        now = time.time()
+        with self._lock:
+            self._check_version(version)
+            key = self._by_message.get((version, message_key))
+            entry = self._entries.get(key) if key else None
+            if entry is None and self.db_path:
+                key, entry = self._load_from_db(message_key, version)
+                if entry is not None:
+                    entry["message_key"] = message_key
+                    self._put(key, message_key, entry)
+            if entry is not None and now - entry["created"] > self.ttl:
+                self._entries.pop(key, None)
+                self._by_message.pop((version, message_key), None)
+                self._stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return dict(entry)
+
+    def store(self, message, question_type, paragraph_ids, answer, version, context=""):
+        """儲存已通過自我檢查的答案；context 需與查詢時相同"""
+        message_key = cache_message_key(message, context)
+        key = self._full_key(version, message_key, question_type, paragraph_ids)
+        entry = {
+            "message_key": message_key,
+            "question_type": question_type,
+            "paragraph_ids": list(paragraph_ids),
+            "answer": answer,
+            "created": time.time(),
+        }
+        with self._lock:
+            self._check_version(version)
+            self._put(key, message_key, entry)
+            self._stats["stores"] += 1
+            if self.db_path:
+                with sqlite3.connect(self.db_path) as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, message_key, version, question_type, json.dumps(entry["paragraph_ids"]), answer, entry["created"]),
+                    )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_message.clear()
+            if self.db_path:
+                with sqlite3.connect(self.db_path) as conn:
+                    conn.execute("DELETE FROM answers")
+
+    def stats(self):
+        with self._lock:
+            total = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "size": len(self._entries),
+                "hit_rate": (self._stats["hits"] / total) if total else 0.0,
+            }
+
+answer_cache = AnswerCache()
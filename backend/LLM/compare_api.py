@@ -1,59 +1,456 @@
 # compare_api.py  (第一份策略 × 第二份介面)
 import os
+import json
+import time
+import fcntl
+import logging
 import sqlite3
+import threading
 import numpy as np
 from typing import List, Tuple
 
+logger = logging.getLogger(__name__)
+
 FEATURE_DB_PATH = os.getenv("FEATURE_DB_PATH", "/app/data/train_features.db")
+# 預先正規化的特徵快照目錄（放在資料卷內，多個 worker 可透過 OS page cache 共用同一份記憶體）
+FEATURE_SNAPSHOT_DIR = os.getenv("FEATURE_SNAPSHOT_DIR", os.path.join(os.path.dirname(FEATURE_DB_PATH), "snapshots"))
+# 每隔幾秒檢查一次特徵資料庫是否變動；0 代表不啟用熱更新
+FEATURE_RELOAD_INTERVAL = float(os.getenv("FEATURE_RELOAD_INTERVAL", "5"))
+# 比對模式：brute（逐筆內積）或 prototype（先以類別原型篩出前 C 個類別，再逐筆精算）
+FEATURE_INDEX_MODE = os.getenv("FEATURE_INDEX_MODE", "brute")
+# prototype 模式下每個類別的子原型數（1 即類別中心），以及精算的候選類別數 C
+FEATURE_INDEX_PROTOTYPES = int(os.getenv("FEATURE_INDEX_PROTOTYPES", "4"))
+FEATURE_INDEX_SHORTLIST = int(os.getenv("FEATURE_INDEX_SHORTLIST", "5"))
+# 正規化特徵的儲存格式：float32（預設）、float16，或 int8（每列一個縮放係數）
+FEATURE_STORAGE = os.getenv("FEATURE_STORAGE", "float32")
+# 精簡格式比對時每次還原成 float32 的列數，限制暫存記憶體
+_SCORE_CHUNK_ROWS = 16384
+# 線上新增／刪除累積超過此筆數時，在背景重建快照把增量併回主矩陣
+FEATURE_COMPACT_ROWS = int(os.getenv("FEATURE_COMPACT_ROWS", "1024"))
 
 # 從SQLite數據庫讀取特徵數據
 def load_features_from_database(db_file):
-    """從SQLite數據庫讀取特徵數據"""
+    """從SQLite數據庫讀取特徵數據，回傳 (row ids, labels, 特徵矩陣 (N, D))"""
     if not os.path.exists(db_file):
         raise FileNotFoundError(f"錯誤：特徵數據庫 {db_file} 不存在")
 
     conn = sqlite3.connect(db_file)
     cursor = conn.cursor()
-    cursor.execute("SELECT label, feature FROM features")
+    cursor.execute("SELECT id, label, feature FROM features ORDER BY id")
     rows = cursor.fetchall()
     conn.close()
 
     if not rows:
         raise RuntimeError("數據庫中沒有特徵記錄")
 
-    labels = []
-    features = []
-    for label, feature_bytes in rows:
-        feature = np.frombuffer(feature_bytes, dtype=np.float32)
-        labels.append(label)
-        features.append(feature)
+    ids, labels, blobs = zip(*rows)
+    ids = np.asarray(ids, dtype=np.int64)
+    sizes = {len(b) for b in blobs}
+    if len(sizes) != 1:
+        raise RuntimeError(f"數據庫中的特徵維度不一致：{sorted(s // 4 for s in sizes)}")
+    # 所有特徵等長：串接後一次 frombuffer，不必逐筆建立陣列
+    F = np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), -1)
+    return ids, list(labels), F
 
-    return features, labels
+# 快取：整份字典在重新載入時一次替換，讀取端只要先取出參照即可拿到一致的快照
+# features_norm：依類別排序後的正規化特徵 (N, D)，格式依 FEATURE_STORAGE；row_scale：int8 時每列的縮放係數
+# row_ids：對應資料庫的 id
+# class_names：類別名稱；class_starts：每個類別在 features_norm 中的起點（線上新增的類別只出現在 delta）
+# delta：線上新增的列（float32 緩衝區，容量倍增，count 之後的內容對這份快取不可見）
+# deleted：已刪除列的位置，主矩陣為 [0, N)，delta 接在 N 之後
+_DB_CACHE = None
+_CACHE_LOCK = threading.Lock()
+_COMPACT_LOCK = threading.Lock()
+_BUILD_LOCK = threading.Lock()
+_PROTOTYPE_LOCK = threading.Lock()
+_WATCHER = None
 
-# 快取
-_DB_CACHE = {"features": None, "labels": None, "features_norm": None}
+# 第一份策略參數
+SIMILARITY_RATIO_THRESHOLD = 1.01
+ABSOLUTE_SIMILARITY_THRESHOLD = 0.72
 
 def _l2_normalize(v: np.ndarray, axis: int = -1, eps: float = 1e-8) -> np.ndarray:
     n = np.linalg.norm(v, axis=axis, keepdims=True)
     n = np.maximum(n, eps)
     return v / n
 
+def _build_class_index(labels: List[str]):
+    """把字串標籤轉成整數編號，並依類別把樣本分組（供 reduceat 做類別聚合）"""
+    class_names, label_ids = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+    label_ids = label_ids.astype(np.int32)
+    order = np.argsort(label_ids, kind="stable").astype(np.int64)
+    class_starts = np.searchsorted(label_ids[order], np.arange(len(class_names))).astype(np.int64)
+    return [str(c) for c in class_names], label_ids, order, class_starts
+
+def _source_signature(db_file: str) -> str:
+    """以資料庫檔案的修改時間與大小作為版本"""
+    st = os.stat(db_file)
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+def _snapshot_stem(signature: str) -> str:
+    return os.path.join(FEATURE_SNAPSHOT_DIR, f"features-{signature}-{FEATURE_STORAGE}")
+
+def _quantize(features_norm: np.ndarray, storage: str):
+    """把正規化特徵轉成儲存格式，回傳 (矩陣, 每列縮放係數或 None)"""
+    if storage == "float32":
+        return np.ascontiguousarray(features_norm, dtype=np.float32), None
+    if storage == "float16":
+        return np.ascontiguousarray(features_norm, dtype=np.float16), None
+    if storage == "int8":
+        scale = np.maximum(np.abs(features_norm).max(axis=1), 1e-8) / 127.0
+        q = np.round(features_norm / scale[:, np.newaxis]).astype(np.int8)
+        return np.ascontiguousarray(q), scale.astype(np.float32)
+    raise ValueError(f"不支援的 FEATURE_STORAGE：{storage}")
+
+def _rows_float32(cache, start: int, end: int) -> np.ndarray:
+    """取出 [start, end) 列並還原成 float32"""
+    rows = np.asarray(cache["features_norm"][start:end], dtype=np.float32)
+    scale = cache.get("row_scale")
+    if scale is not None:
+        rows = rows * np.asarray(scale[start:end])[:, np.newaxis]
+    return rows
+
+def _similarities(cache, q_norm: np.ndarray, start: int = 0, end: int = None) -> np.ndarray:
+    """q_norm (B, D) 與第 [start, end) 列的內積；精簡格式分塊還原，不會整份展開成 float32；已刪除的列為 -inf"""
+    F = cache["features_norm"]
+    end = F.shape[0] if end is None else end
+    if F.dtype == np.float32:
+        out = q_norm @ F[start:end].T
+    else:
+        out = np.empty((q_norm.shape[0], end - start), dtype=np.float32)
+        for s in range(start, end, _SCORE_CHUNK_ROWS):
+            e = min(s + _SCORE_CHUNK_ROWS, end)
+            if cache.get("row_scale") is not None:
+                # int8：先與整數矩陣相乘，再乘上每列縮放係數
+                out[:, s - start:e - start] = (q_norm @ F[s:e].T.astype(np.float32)) * cache["row_scale"][s:e]
+            else:
+                out[:, s - start:e - start] = q_norm @ F[s:e].T.astype(np.float32)
+    deleted = cache.get("deleted")
+    if deleted is not None and deleted.shape[0]:
+        hit = deleted[np.searchsorted(deleted, start):np.searchsorted(deleted, end)]
+        out[:, hit - start] = -np.inf
+    return out
+
+def _delta_class_max(cache, q_norm: np.ndarray) -> np.ndarray:
+    """線上新增列對各類別的最高相似度 (B, C)；沒有該類別的列時為 -inf"""
+    out = np.full((q_norm.shape[0], len(cache["class_names"])), -np.inf, dtype=np.float32)
+    delta = cache.get("delta")
+    if delta is None or delta["count"] == 0:
+        return out
+    n = delta["count"]
+    sims = q_norm @ delta["features"][:n].T  # (B, n)
+    base_rows = cache["features_norm"].shape[0]
+    deleted = cache["deleted"]
+    hit = deleted[deleted >= base_rows] - base_rows
+    sims[:, hit] = -np.inf
+    np.maximum.at(out.T, delta["label_ids"][:n], sims.T)
+    return out
+
+def _merge_delta(base_max: np.ndarray, cache, q_norm: np.ndarray) -> np.ndarray:
+    """把主矩陣的類別最高值 (B, C_base) 補齊成全部類別，並與 delta 取最大值"""
+    n_classes = len(cache["class_names"])
+    if base_max.shape[1] == n_classes and (cache.get("delta") is None or cache["delta"]["count"] == 0):
+        return base_max
+    out = _delta_class_max(cache, q_norm)
+    out[:, :base_max.shape[1]] = np.maximum(out[:, :base_max.shape[1]], base_max)
+    return out
+
+def _atomic_write(path: str, write):
+    """先寫暫存檔再 os.replace，讀取端不會看到寫到一半的檔案"""
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _compile_arrays(db_file: str, signature: str):
+    """從 SQLite 讀出特徵並整理成依類別排序、預先正規化的矩陣（格式依 FEATURE_STORAGE）"""
+    ids, labels, F = load_features_from_database(db_file)
+    # 一次性正規化訓練特徵（符合第一份策略：先正規化，再用內積作餘弦）
+    features_norm = _l2_normalize(F, axis=1)
+    class_names, _, order, class_starts = _build_class_index(labels)
+    # 事先依類別排好順序，比對時相似度即為類別連續區塊
+    matrix, row_scale = _quantize(features_norm[order], FEATURE_STORAGE)
+    return {
+        "signature": signature,
+        "features_norm": matrix,
+        "row_scale": row_scale,
+        "row_ids": ids[order],
+        "class_names": class_names,
+        "class_starts": class_starts,
+        "delta": None,
+        "deleted": np.empty(0, dtype=np.int64),
+    }
+
+def build_snapshot(db_file: str, signature: str):
+    """編譯特徵快照檔；索引 json 最後寫入，存在即代表快照完整"""
+    cache = _compile_arrays(db_file, signature)
+    os.makedirs(FEATURE_SNAPSHOT_DIR, exist_ok=True)
+    stem = _snapshot_stem(signature)
+    _atomic_write(stem + ".npy", lambda f: np.save(f, cache["features_norm"]))
+    _atomic_write(stem + ".ids.npy", lambda f: np.save(f, cache["row_ids"]))
+    if cache["row_scale"] is not None:
+        _atomic_write(stem + ".scale.npy", lambda f: np.save(f, cache["row_scale"]))
+    index = {
+        "signature": signature,
+        "storage": FEATURE_STORAGE,
+        "count": int(cache["features_norm"].shape[0]),
+        "dim": int(cache["features_norm"].shape[1]),
+        "class_names": cache["class_names"],
+        "class_starts": cache["class_starts"].tolist(),
+    }
+    _atomic_write(stem + ".json", lambda f: f.write(json.dumps(index, ensure_ascii=False).encode("utf-8")))
+    return cache
+
+def open_snapshot(signature: str):
+    """以 mmap 開啟既有快照；不存在時回傳 None"""
+    stem = _snapshot_stem(signature)
+    if not os.path.isfile(stem + ".json"):
+        return None
+    with open(stem + ".json", encoding="utf-8") as f:
+        index = json.load(f)
+    has_scale = os.path.isfile(stem + ".scale.npy")
+    return {
+        "signature": signature,
+        # 實際 mmap 的快照版本；線上增量會改寫 signature，但底層檔案不變
+        "snapshot": signature,
+        "features_norm": np.load(stem + ".npy", mmap_mode="r"),
+        "row_scale": np.load(stem + ".scale.npy", mmap_mode="r") if has_scale else None,
+        "row_ids": np.load(stem + ".ids.npy", mmap_mode="r"),
+        "class_names": index["class_names"],
+        "class_starts": np.asarray(index["class_starts"], dtype=np.int64),
+        "delta": None,
+        "deleted": np.empty(0, dtype=np.int64),
+    }
+
+def _remove_stale_snapshots(*keep_signatures: str):
+    """
+    刪除 keep_signatures 以外的舊版快照。呼叫端會保留正在替換掉的那一版，
+    它要等下一次重新載入才刪除，這時已沒有請求還拿著它的參照。
+    其他 worker 可能仍在 mmap 更舊的檔案：POSIX 上已 unlink 的檔案在解除映射前仍可讀取；
+    Windows 上刪除仍被映射的檔案會失敗，就略過，留到之後的重新載入再刪。
+    """
+    keep = {os.path.basename(_snapshot_stem(signature)) + "." for signature in keep_signatures if signature}
+    try:
+        names = os.listdir(FEATURE_SNAPSHOT_DIR)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith("features-") and not any(name.startswith(k) for k in keep) and not name.endswith(".tmp"):
+            try:
+                os.remove(os.path.join(FEATURE_SNAPSHOT_DIR, name))
+            except OSError:
+                pass
+
+def _load_cache(signature: str):
+    # 熱更新與增量重建可能同時觸發，同一個行程內一次只建一份
+    with _BUILD_LOCK:
+        cache = open_snapshot(signature)
+        if cache is not None:
+            return cache
+        try:
+            compiled = build_snapshot(FEATURE_DB_PATH, signature)
+        except OSError as e:
+            # 快照目錄不可寫時退回純記憶體快取
+            logger.warning(f"無法寫入特徵快照 {FEATURE_SNAPSHOT_DIR}：{e}，改用記憶體快取")
+            return _compile_arrays(FEATURE_DB_PATH, signature)
+        try:
+            cache = open_snapshot(signature)
+        except OSError:
+            # 其他 worker 已換上更新的版本並清掉這份快照，先用剛編譯好的陣列
+            cache = None
+        # 目前使用中的快照可能還有請求在讀，這次先保留
+        current = _DB_CACHE
+        _remove_stale_snapshots(signature, current.get("snapshot") if current is not None else None)
+        return cache if cache is not None else compiled
+
+def reload_cache(force: bool = False) -> bool:
+    """
+    資料庫有變動時重建快照並整份替換快取；回傳是否有替換。
+    force=True 時即使版本相同也重建（用來把線上增量併回主矩陣）。
+    """
+    global _DB_CACHE
+    signature = _source_signature(FEATURE_DB_PATH)
+    current = _DB_CACHE
+    if not force and current is not None and current["signature"] == signature:
+        return False
+    cache = _prepare_index(_load_cache(signature))
+    with _CACHE_LOCK:
+        # 重建期間若資料庫或快取又被改動，放棄這次替換，交給下一輪處理
+        if _source_signature(FEATURE_DB_PATH) != signature or _DB_CACHE is not current:
+            return False
+        _DB_CACHE = cache
+    logger.info(f"特徵快取已更新：{cache['features_norm'].shape[0]} 筆，{len(cache['class_names'])} 類")
+    return True
+
+def _watch_database():
+    while True:
+        time.sleep(FEATURE_RELOAD_INTERVAL)
+        try:
+            reload_cache()
+        except Exception as e:
+            # 重建失敗時沿用舊快取，下一輪再試
+            logger.error(f"特徵快取熱更新失敗：{e}")
+
+def _start_watcher():
+    global _WATCHER
+    if FEATURE_RELOAD_INTERVAL <= 0 or _WATCHER is not None:
+        return
+    with _CACHE_LOCK:
+        if _WATCHER is None:
+            _WATCHER = threading.Thread(target=_watch_database, name="feature-cache-watcher", daemon=True)
+            _WATCHER.start()
+
 def ensure_cache():
-    if _DB_CACHE["features"] is None:
-        feats, labels = load_features_from_database(FEATURE_DB_PATH)
-        _DB_CACHE["features"] = feats
-        _DB_CACHE["labels"] = labels
-        # 一次性正規化訓練特徵（符合第一份策略：先正規化，再用內積作餘弦）
+    """回傳目前的特徵快取；首次呼叫時載入並啟動背景熱更新"""
+    global _DB_CACHE
+    cache = _DB_CACHE
+    if cache is None:
+        with _CACHE_LOCK:
+            if _DB_CACHE is None:
+                _DB_CACHE = _prepare_index(_load_cache(_source_signature(FEATURE_DB_PATH)))
+            cache = _DB_CACHE
+        _start_watcher()
+    return cache
+
+def feature_dim() -> int:
+    """目前特徵快取的向量維度"""
+    return int(ensure_cache()["features_norm"].shape[1])
+
+def _append_delta(delta, vector: np.ndarray, label_id: int, row_id: int):
+    """回傳多了一列的新 delta；容量不足時倍增，舊快取仍指向原緩衝區"""
+    if delta is None:
+        capacity = 64
+        delta = {
+            "features": np.empty((capacity, vector.shape[0]), dtype=np.float32),
+            "label_ids": np.empty(capacity, dtype=np.int64),
+            "row_ids": np.empty(capacity, dtype=np.int64),
+            "count": 0,
+        }
+    n = delta["count"]
+    if n == delta["features"].shape[0]:
+        grown = {}
+        for key in ("features", "label_ids", "row_ids"):
+            buf = np.empty((n * 2,) + delta[key].shape[1:], dtype=delta[key].dtype)
+            buf[:n] = delta[key][:n]
+            grown[key] = buf
+        delta = {**delta, **grown}
+    # 寫在 count 之後的位置，持有舊快取的讀取端看不到
+    delta["features"][n] = vector
+    delta["label_ids"][n] = label_id
+    delta["row_ids"][n] = row_id
+    return {**delta, "count": n + 1}
+
+def _maybe_compact(cache):
+    """增量累積過多時在背景重建快照"""
+    delta_rows = cache["delta"]["count"] if cache.get("delta") else 0
+    if delta_rows + cache["deleted"].shape[0] < FEATURE_COMPACT_ROWS:
+        return
+    # 同一時間只跑一個重建
+    if not _COMPACT_LOCK.acquire(blocking=False):
+        return
+    def compact():
         try:
-            F = np.stack(feats, axis=0)  # (N, D)
-        except Exception:
-            # 維度不一致時退回逐筆處理
-            F = None
-        if F is not None:
-            _DB_CACHE["features_norm"] = _l2_normalize(F, axis=1)  # (N, D)
-        else:
-            # 逐筆正規化
-            _DB_CACHE["features_norm"] = np.stack([_l2_normalize(f[np.newaxis, :], axis=1).squeeze(0) for f in feats], axis=0)
+            # 重建期間又有新增／刪除時替換會被放棄，持續重試直到增量不再超量
+            while not reload_cache(force=True):
+                current = _DB_CACHE
+                if (current["delta"]["count"] if current.get("delta") else 0) + current["deleted"].shape[0] < FEATURE_COMPACT_ROWS:
+                    break
+        except Exception as e:
+            logger.error(f"特徵快照重建失敗：{e}")
+        finally:
+            _COMPACT_LOCK.release()
+    threading.Thread(target=compact, name="feature-cache-compact", daemon=True).start()
+
+def _write_database(sql: str, params: tuple):
+    """
+    在跨 worker 的檔案鎖內寫入 SQLite；回傳 (lastrowid, rowcount, 寫入前版本, 寫入後版本)。
+    鎖內前後兩次取版本，中間不會夾雜其他 worker 的寫入。
+    """
+    with open(FEATURE_DB_PATH + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        before = _source_signature(FEATURE_DB_PATH)
+        conn = sqlite3.connect(FEATURE_DB_PATH)
+        try:
+            cursor = conn.execute(sql, params)
+            conn.commit()
+            result = (cursor.lastrowid, cursor.rowcount)
+        finally:
+            conn.close()
+        after = _source_signature(FEATURE_DB_PATH)
+    return result + (before, after)
+
+def add_feature(label: str, vector: List[float], file_path: str = None):
+    """新增一筆特徵：寫入 SQLite 並就地更新快取，不需重新載入整份資料；回傳新列的 id"""
+    global _DB_CACHE
+    ensure_cache()
+    v = np.asarray(vector, dtype=np.float32).ravel()
+    with _CACHE_LOCK:
+        cache = _DB_CACHE
+        dim = cache["features_norm"].shape[1]
+        if v.shape[0] != dim:
+            raise ValueError(f"特徵維度不符：預期 {dim}，收到 {v.shape[0]}")
+        row_id, _, before, after = _write_database(
+            "INSERT INTO features (file_path, label, feature) VALUES (?, ?, ?)",
+            (file_path, label, v.tobytes()),
+        )
+        # 寫入前資料庫已被其他 worker 改過：就地更新會漏掉那些變動，改為整份重新載入
+        stale = before != cache["signature"]
+        if not stale:
+            class_names = cache["class_names"]
+            if label not in class_names:
+                class_names = class_names + [label]
+            new_cache = {
+                **cache,
+                # 只有這次寫入造成的版本變動才沿用，不觸發熱更新重建
+                "signature": after,
+                "class_names": class_names,
+                "delta": _append_delta(cache.get("delta"), _l2_normalize(v), class_names.index(label), row_id),
+            }
+            _DB_CACHE = new_cache
+    if stale:
+        reload_cache()
+    else:
+        _maybe_compact(new_cache)
+    return row_id
+
+def remove_feature(row_id: int) -> bool:
+    """刪除一筆特徵：從 SQLite 移除並在快取中標記刪除；找不到時回傳 False"""
+    global _DB_CACHE
+    ensure_cache()
+    with _CACHE_LOCK:
+        cache = _DB_CACHE
+        _, rowcount, before, after = _write_database("DELETE FROM features WHERE id = ?", (int(row_id),))
+        if rowcount <= 0:
+            return False
+        stale = before != cache["signature"]
+        if not stale:
+            positions = np.flatnonzero(np.asarray(cache["row_ids"]) == row_id)
+            delta = cache.get("delta")
+            if delta is not None:
+                hit = np.flatnonzero(delta["row_ids"][:delta["count"]] == row_id)
+                positions = np.concatenate([positions, hit + cache["features_norm"].shape[0]])
+            new_cache = {
+                **cache,
+                "signature": after,
+                "deleted": np.union1d(cache["deleted"], positions).astype(np.int64),
+            }
+            # 原型只涵蓋主矩陣：重算被刪列所在的類別，避免粗篩選到已無樣本的類別
+            base_positions = positions[positions < cache["features_norm"].shape[0]]
+            affected = set(np.searchsorted(cache["class_starts"], base_positions, side="right") - 1)
+            new_cache["prototypes"] = {
+                k: _build_prototypes(new_cache, k, index, affected) if affected else index
+                for k, index in cache.get("prototypes", {}).items()
+            }
+            _DB_CACHE = new_cache
+    if stale:
+        reload_cache()
+    else:
+        _maybe_compact(new_cache)
+    return True
 
 def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
     # 保留介面，但實際決策改用「先正規化後內積」以對齊第一份策略
@@ -62,71 +459,141 @@ def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
         return 0.0
     return float(np.dot(a, b) / denom)
 
-def compare_vector(spotName: str, vector: List[float]):
-    """
-    介面與回傳格式維持第二份。
-    策略採用第一份：類別最高相似度的比例門檻 1.01 + 絕對門檻 0.72。
-    """
-    ensure_cache()
-    train_features = _DB_CACHE["features"]
-    train_labels = _DB_CACHE["labels"]
-    train_features_norm = _DB_CACHE["features_norm"]  # (N, D)
+def _spherical_kmeans(X: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """在單位球面上做 k-means，回傳 (k, D) 的正規化中心"""
+    if k <= 1 or X.shape[0] <= k:
+        centers = X.mean(axis=0, keepdims=True) if k <= 1 else np.array(X)
+        return _l2_normalize(centers, axis=1).astype(np.float32)
+    rng = np.random.default_rng(seed)
+    centers = np.array(X[rng.choice(X.shape[0], k, replace=False)])
+    for _ in range(iters):
+        assign = np.argmax(X @ centers.T, axis=1)
+        for j in range(k):
+            members = X[assign == j]
+            # 空群沿用舊中心
+            if members.shape[0]:
+                centers[j] = members.mean(axis=0)
+        centers = _l2_normalize(centers, axis=1)
+    return centers.astype(np.float32)
 
-    q = np.asarray(vector, dtype=np.float32).reshape(1, -1)  # (1, D)
-    q_norm = _l2_normalize(q, axis=1)  # (1, D)
+def _class_prototypes(cache, bounds: np.ndarray, c: int, k: int):
+    """第 c 類別未刪除列的 k 個子原型；整類都已刪除時回傳 (零向量, True)"""
+    start, end = int(bounds[c]), int(bounds[c + 1])
+    rows = _rows_float32(cache, start, end)
+    deleted = cache["deleted"]
+    hit = deleted[np.searchsorted(deleted, start):np.searchsorted(deleted, end)] - start
+    if hit.shape[0]:
+        rows = np.delete(rows, hit, axis=0)
+    if rows.shape[0] == 0:
+        return np.zeros((1, rows.shape[1]), dtype=np.float32), True
+    return _spherical_kmeans(rows, k), False
 
-    # 與全部訓練特徵的相似度：內積（等同餘弦）
-    sims = (q_norm @ train_features_norm.T).astype(np.float32).ravel()  # (N,)
+def _build_prototypes(cache, k: int, previous=None, classes=None):
+    """建立原型索引；給了 previous 時只重算 classes 內的類別，其餘沿用"""
+    F = cache["features_norm"]
+    bounds = np.append(cache["class_starts"], F.shape[0])
+    per_class, dead = [], []
+    for c in range(len(bounds) - 1):
+        if previous is not None and c not in classes:
+            protos, is_dead = previous["per_class"][c], bool(previous["dead"][c])
+        else:
+            protos, is_dead = _class_prototypes(cache, bounds, c, k)
+        per_class.append(protos)
+        dead.append(is_dead)
+    return {
+        "per_class": per_class,
+        "prototypes": np.concatenate(per_class, axis=0),
+        "proto_starts": np.cumsum([0] + [p.shape[0] for p in per_class[:-1]]).astype(np.int64),
+        # 整類都已刪除的類別，粗篩分數固定為 -inf
+        "dead": np.asarray(dead, dtype=bool),
+    }
 
-    # 依樣本排序
-    idx_sorted = np.argsort(-sims)
-    similarities: List[Tuple[str, float]] = [(train_labels[i], float(sims[i])) for i in idx_sorted]
+def _ensure_prototypes(cache, k: int):
+    """建立（並快取在這份快取上）每個類別的 k 個子原型；同一時間只建一份"""
+    prototypes = cache.setdefault("prototypes", {})
+    index = prototypes.get(k)
+    if index is not None:
+        return index
+    with _PROTOTYPE_LOCK:
+        index = prototypes.get(k)
+        if index is None:
+            index = prototypes[k] = _build_prototypes(cache, k)
+    return index
 
-    # 若完全無可用樣本
-    if len(similarities) == 0:
-        return {
-            "predicted": "未知類別",
-            "score": 0.0,
-            "matched": False,
-            "reason": "訓練集特徵為空"
-        }
+def _prepare_index(cache):
+    """原型模式下在快取換上之前先建好原型，第一個 /compare 不必在請求內跑 k-means"""
+    if FEATURE_INDEX_MODE == "prototype":
+        _ensure_prototypes(cache, FEATURE_INDEX_PROTOTYPES)
+    return cache
 
-    # 樣本層級 Top-1（供 score 與資訊用）
-    most_similar_class, highest_similarity = similarities[0]
+def warm_index():
+    """載入特徵快取並確保原型已建立（啟動預熱用）"""
+    return _prepare_index(ensure_cache())
 
-    # 依「類別」聚合，取各類別最高相似度
-    class_best = {}
-    for label, sim in similarities:
-        # 保留此類別的最高相似度
-        if label not in class_best or sim > class_best[label]:
-            class_best[label] = sim
+def _shortlist_class_max(q_norm: np.ndarray, cache, shortlist: int, k: int) -> np.ndarray:
+    """兩階段比對：原型粗篩前 shortlist 個類別，只對這些類別的樣本精算餘弦；其餘類別回傳 -inf"""
+    index = _ensure_prototypes(cache, k)
+    coarse = np.maximum.reduceat(q_norm @ index["prototypes"].T, index["proto_starts"], axis=1)  # (B, C)
+    coarse[:, index["dead"]] = -np.inf
+    candidates = np.argpartition(-coarse, shortlist - 1, axis=1)[:, :shortlist]
+    F = cache["features_norm"]
+    bounds = np.append(cache["class_starts"], F.shape[0])
+    out = np.full(coarse.shape, -np.inf, dtype=np.float32)
+    for b in range(q_norm.shape[0]):
+        for c in candidates[b]:
+            out[b, c] = np.max(_similarities(cache, q_norm[b:b + 1], bounds[c], bounds[c + 1]))
+    # 線上新增的列數量少，直接全部精算
+    return _merge_delta(out, cache, q_norm)
 
-    # 依「類別最高相似度」排序
-    sorted_classes = sorted(class_best.items(), key=lambda x: x[1], reverse=True)
+def class_max_similarities(Q: np.ndarray, cache=None, shortlist: int = None, prototypes: int = None) -> np.ndarray:
+    """
+    一次計算多筆查詢向量對各類別的最高相似度。
+    Q: (B, D) 未正規化查詢；回傳 (B, C)，C 為類別數。
+    shortlist 為 0 時逐筆比對全部樣本；大於 0 時使用原型索引，只精算前 shortlist 個類別。
+    """
+    if cache is None:
+        cache = ensure_cache()
+    if shortlist is None:
+        shortlist = FEATURE_INDEX_SHORTLIST if FEATURE_INDEX_MODE == "prototype" else 0
+    q_norm = _l2_normalize(np.asarray(Q, dtype=np.float32), axis=1)  # (B, D)
+    # 至少精算兩個類別，比例門檻才有真實的次高類別可比
+    if 0 < shortlist < len(cache["class_starts"]):
+        return _shortlist_class_max(q_norm, cache, max(shortlist, 2), prototypes or FEATURE_INDEX_PROTOTYPES)
+    # 與全部訓練特徵的相似度：內積（等同餘弦），欄位已依類別分組
+    sims = _similarities(cache, q_norm)  # (B, N)
+    base_max = np.maximum.reduceat(sims, cache["class_starts"], axis=1)  # (B, C)
+    return _merge_delta(base_max, cache, q_norm)
 
-    # 取得最佳與次佳類別的最高相似度
-    best_class, best_sim = sorted_classes[0]
-    if len(sorted_classes) > 1:
-        second_best_class, second_best_sim = sorted_classes[1]
-    else:
-        second_best_class, second_best_sim = "N/A", 0.0
+def _top2(class_best: np.ndarray):
+    """回傳 (最佳類別編號, 最佳相似度, 次佳類別編號, 次佳相似度)，次佳不存在時為 (-1, 0.0)"""
+    if class_best.shape[0] == 1:
+        return 0, float(class_best[0]), -1, 0.0
+    top = np.argpartition(-class_best, 1)[:2]
+    if class_best[top[1]] > class_best[top[0]]:
+        top = top[::-1]
+    return int(top[0]), float(class_best[top[0]]), int(top[1]), float(class_best[top[1]])
 
-    # 第一份策略參數
-    similarity_ratio_threshold = 1.01
-    absolute_similarity_threshold = 0.72
+def _decide(spotName: str, class_best: np.ndarray, class_names: List[str]):
+    """依類別最高相似度套用比例門檻與絕對門檻，組成回傳格式"""
+    # 樣本全被刪除（或未進入精算）的類別為 -inf，不參與比較
+    live = np.flatnonzero(np.isfinite(class_best))
+    if live.shape[0] == 0:
+        return dict(_EMPTY_RESULT)
+    best_id, best_sim, _, second_best_sim = _top2(class_best[live])
+    best_class = class_names[live[best_id]]
 
     # 比例門檻判斷
     if second_best_sim > 1e-8:
         similarity_ratio = best_sim / second_best_sim
-        passed_ratio = similarity_ratio > similarity_ratio_threshold
-        ratio_reason = f"最高類別/次高類別 = {best_sim:.4f}/{second_best_sim:.4f} = {similarity_ratio:.4f} {'>' if passed_ratio else '<='} {similarity_ratio_threshold}"
+        passed_ratio = similarity_ratio > SIMILARITY_RATIO_THRESHOLD
+        ratio_reason = f"最高類別/次高類別 = {best_sim:.4f}/{second_best_sim:.4f} = {similarity_ratio:.4f} {'>' if passed_ratio else '<='} {SIMILARITY_RATIO_THRESHOLD}"
     else:
         passed_ratio = True  # 僅有一個類別或次高極低，視為通過
         ratio_reason = f"僅一類別或次高極低({second_best_sim:.4f})，視為通過比例門檻"
 
     # 絕對門檻判斷
-    passed_abs = best_sim > absolute_similarity_threshold
-    abs_reason = f"最高相似度 {best_sim:.4f} {'>' if passed_abs else '<='} {absolute_similarity_threshold}"
+    passed_abs = best_sim > ABSOLUTE_SIMILARITY_THRESHOLD
+    abs_reason = f"最高相似度 {best_sim:.4f} {'>' if passed_abs else '<='} {ABSOLUTE_SIMILARITY_THRESHOLD}"
 
     # 綜合門檻
     if passed_ratio and passed_abs:
@@ -138,7 +605,40 @@ def compare_vector(spotName: str, vector: List[float]):
 
     return {
         "predicted": predicted,
-        "score": float(highest_similarity),  # 與原系統一致，回報樣本層級的最高相似度
+        # 與原系統一致，回報樣本層級的最高相似度（即所有類別最高值中的最大者）
+        "score": best_sim,
         "matched": bool(predicted == spotName),
         "reason": reason
     }
+
+_EMPTY_RESULT = {
+    "predicted": "未知類別",
+    "score": 0.0,
+    "matched": False,
+    "reason": "訓練集特徵為空"
+}
+
+def compare_vectors(items: List[Tuple[str, List[float]]]):
+    """
+    批次比對：items 為 (spotName, vector) 列表，所有查詢以一次矩陣乘法計算。
+    回傳與 compare_vector 相同格式的結果列表（順序與輸入一致）。
+    """
+    if not items:
+        return []
+    # 整個批次使用同一份快取，熱更新替換時不會讀到新舊混合的資料
+    cache = ensure_cache()
+    # 若完全無可用樣本
+    if len(cache["class_names"]) == 0:
+        return [dict(_EMPTY_RESULT) for _ in items]
+
+    Q = np.asarray([vector for _, vector in items], dtype=np.float32)  # (B, D)
+    class_best = class_max_similarities(Q, cache)  # (B, C)
+    class_names = cache["class_names"]
+    return [_decide(spotName, class_best[i], class_names) for i, (spotName, _) in enumerate(items)]
+
+def compare_vector(spotName: str, vector: List[float]):
+    """
+    介面與回傳格式維持第二份。
+    策略採用第一份：類別最高相似度的比例門檻 1.01 + 絕對門檻 0.72。
+    """
+    return compare_vectors([(spotName, vector)])[0]
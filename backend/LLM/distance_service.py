@@ -0,0 +1,246 @@
+# distance_service.py
+# 步行距離查詢服務：共用 HTTP 連線池、並行查詢多段路線、以 SQLite 快取結果，API 失敗時以直線距離估算。
+import os
+import time
+import sqlite3
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from metrics import DIRECTIONS_SECONDS
+from walking_graph import WalkingGraph, RoutingUnavailable, haversine_meters, WALK_DETOUR_FACTOR, WALK_SPEED_MPS
+
+logger = logging.getLogger(__name__)
+
+# 路線來源：google（Directions API）、local（離線校園路網）、local_first（先查路網，查不到再問 Google）
+ROUTING_BACKEND = os.getenv("ROUTING_BACKEND", "google")
+# 可改成本地的模擬 Directions 伺服器做測試
+GOOGLE_DIRECTIONS_URL = os.getenv("GOOGLE_DIRECTIONS_URL", "https://maps.googleapis.com/maps/api/directions/json")
+DISTANCE_TIMEOUT = float(os.getenv("DISTANCE_TIMEOUT", "5"))
+DISTANCE_CACHE_DB = os.getenv("DISTANCE_CACHE_DB", "cache/distances.db")
+DISTANCE_CACHE_TTL = float(os.getenv("DISTANCE_CACHE_TTL", str(7 * 86400)))
+# 起點對齊的格點大小（度）；約 50 公尺內的玩家共用同一筆快取
+START_GRID_DEGREES = float(os.getenv("DISTANCE_START_GRID", "0.0005"))
+DISTANCE_WORKERS = int(os.getenv("DISTANCE_WORKERS", "8"))
+# 校園路網載入失敗後，間隔幾秒再重試
+CAMPUS_GRAPH_RETRY_SECONDS = float(os.getenv("CAMPUS_GRAPH_RETRY_SECONDS", "60"))
+
+def estimate_walk(lat1, lon1, lat2, lon2):
+    """以直線距離估算步行 (distance_meters, duration_seconds)"""
+    distance = haversine_meters(lat1, lon1, lat2, lon2) * WALK_DETOUR_FACTOR
+    return int(round(distance)), int(round(distance / WALK_SPEED_MPS))
+
+def snap_to_grid(lat, lon, grid=START_GRID_DEGREES):
+    return round(round(lat / grid) * grid, 6), round(round(lon / grid) * grid, 6)
+
+class DistanceService:
+    """
+    步行距離查詢：Google Directions 附連線池、快取與直線距離備援；
+    設定 graph（WalkingGraph）時依 backend 改由離線路網計算。
+    """
+
+    def __init__(self, api_key=None, base_url=GOOGLE_DIRECTIONS_URL, timeout=DISTANCE_TIMEOUT,
+                 cache_db=DISTANCE_CACHE_DB, ttl=DISTANCE_CACHE_TTL, grid=START_GRID_DEGREES, workers=DISTANCE_WORKERS,
+                 graph=None, backend="google"):
+        self.api_key = api_key
+        self.graph = graph
+        self.backend = backend if graph is not None else "google"
+        self.base_url = base_url
+        self.timeout = timeout
+        self.cache_db = cache_db
+        self.ttl = ttl
+        self.grid = grid
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="distance")
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=workers))
+        self._session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=workers))
+        self._memory = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "fallbacks": 0, "local": 0}
+        if cache_db:
+            os.makedirs(os.path.dirname(cache_db) or ".", exist_ok=True)
+            with sqlite3.connect(cache_db) as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS legs (key TEXT PRIMARY KEY, distance INTEGER, duration INTEGER, created REAL)")
+
+    @staticmethod
+    def _key(lat1, lon1, lat2, lon2):
+        return f"{lat1:.5f},{lon1:.5f}|{lat2:.5f},{lon2:.5f}"
+
+    def _cache_get(self, key):
+        now = time.time()
+        with self._lock:
+            hit = self._memory.get(key)
+        if hit is None and self.cache_db:
+            with sqlite3.connect(self.cache_db) as conn:
+                row = conn.execute("SELECT distance, duration, created FROM legs WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                hit = row
+                with self._lock:
+                    self._memory[key] = hit
+        if hit is None or now - hit[2] > self.ttl:
+            return None
+        return hit[0], hit[1]
+
+    def _cache_put(self, key, distance, duration):
+        entry = (distance, duration, time.time())
+        with self._lock:
+            self._memory[key] = entry
+        if self.cache_db:
+            with sqlite3.connect(self.cache_db) as conn:
+                conn.execute("INSERT OR REPLACE INTO legs VALUES (?, ?, ?, ?)", (key,) + entry)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def fetch(self, lat1, lon1, lat2, lon2):
+        """直接查詢 Directions API（不經快取），失敗時丟出例外"""
+        if not self.api_key:
+            raise RuntimeError("未設定 GOOGLE_MAPS_API_KEY")
+        params = {
+            "origin": f"{lat1},{lon1}",
+            "destination": f"{lat2},{lon2}",
+            "mode": "walking",
+            "language": "zh-TW",
+            "key": self.api_key
+        }
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = self._session.get(self.base_url, params=params, timeout=self.timeout)
+            data = response.json()
+            status = data.get("status", "error")
+        finally:
+            DIRECTIONS_SECONDS.observe(time.perf_counter() - started, status=status)
+        if data["status"] == "OK":
+            leg = data["routes"][0]["legs"][0]
+            # 距離（公尺）、預估時間（秒）
+            return leg["distance"]["value"], leg["duration"]["value"]
+        raise Exception(f"Google API Error: {data['status']}")
+
+    def _leg(self, lat1, lon1, lat2, lon2, snap_origin=False):
+        """回傳 (distance_meters, duration_seconds, 是否為直線距離估算)"""
+        if self.backend in ("local", "local_first"):
+            try:
+                distance, duration = self.graph.route(lat1, lon1, lat2, lon2)
+                self._count("local")
+                return distance, duration, False
+            except RoutingUnavailable as e:
+                if self.backend == "local":
+                    self._count("fallbacks")
+                    logger.warning(f"校園路網無法計算（{e}），改用直線距離估算")
+                    return estimate_walk(lat1, lon1, lat2, lon2) + (True,)
+        if snap_origin:
+            lat1, lon1 = snap_to_grid(lat1, lon1, self.grid)
+        key = self._key(lat1, lon1, lat2, lon2)
+        cached = self._cache_get(key)
+        if cached is not None:
+            self._count("hits")
+            return cached + (False,)
+        self._count("misses")
+        try:
+            distance, duration = self.fetch(lat1, lon1, lat2, lon2)
+        except Exception as e:
+            self._count("fallbacks")
+            logger.warning(f"Directions API 無法使用（{e}），改用直線距離估算")
+            return estimate_walk(lat1, lon1, lat2, lon2) + (True,)
+        self._cache_put(key, distance, duration)
+        return distance, duration, False
+
+    def leg(self, lat1, lon1, lat2, lon2, snap_origin=False):
+        """
+        回傳 (distance_meters, duration_seconds)。
+        snap_origin=True 時起點先對齊格點，附近的玩家可共用快取；API 逾時或失敗時改用直線距離估算。
+        local_first 時路網查不到（不在路網上或不連通）才改問 Google。
+        """
+        distance, duration, _ = self._leg(lat1, lon1, lat2, lon2, snap_origin)
+        return distance, duration
+
+    def warm(self, points):
+        """預先為地標建立路網最短路徑樹（僅離線路網有效）；points 為 [(lat, lon), ...]"""
+        if self.graph is not None:
+            self.graph.warm(points)
+
+    def batch(self, pairs, snap_origin=False):
+        """並行查詢多組 (lat1, lon1, lat2, lon2)；回傳 [(distance, duration), ...]，順序與 pairs 相同"""
+        futures = [self._pool.submit(self.leg, *pair, snap_origin) for pair in pairs]
+        return [f.result() for f in futures]
+
+    def batch_estimated(self, pairs, snap_origin=False):
+        """同 batch，另回傳其中以直線距離估算（API 或路網失敗）的段數：([(distance, duration), ...], 估算段數)"""
+        futures = [self._pool.submit(self._leg, *pair, snap_origin) for pair in pairs]
+        results = [f.result() for f in futures]
+        return [(d, t) for d, t, _ in results], sum(1 for *_, estimated in results if estimated)
+
+    def legs(self, points, snap_first=True):
+        """依序經過 points（每個含 latitude / longitude）的各段距離，並行查詢；回傳 [(distance, duration), ...]"""
+        futures = []
+        for i in range(len(points) - 1):
+            p1, p2 = points[i], points[i + 1]
+            futures.append(self._pool.submit(
+                self.leg, p1["latitude"], p1["longitude"], p2["latitude"], p2["longitude"], snap_first and i == 0
+            ))
+        return [f.result() for f in futures]
+
+_services = {}
+_services_lock = threading.Lock()
+_graph = None
+_graph_lock = threading.Lock()
+_graph_attempted = None
+
+def _load_graph():
+    """
+    依 ROUTING_BACKEND 載入校園路網；載入失敗時記錄錯誤並回傳 None（此時實際改用 Google）。
+    失敗後每隔 CAMPUS_GRAPH_RETRY_SECONDS 才重試，不會每個請求都重新解析路網檔。
+    """
+    global _graph, _graph_attempted
+    if ROUTING_BACKEND not in ("local", "local_first"):
+        return None
+    with _graph_lock:
+        now = time.monotonic()
+        if _graph is None and (_graph_attempted is None or now - _graph_attempted >= CAMPUS_GRAPH_RETRY_SECONDS):
+            _graph_attempted = now
+            try:
+                _graph = WalkingGraph.load()
+            except Exception as e:
+                logger.error(f"校園路網載入失敗（{e}），ROUTING_BACKEND={ROUTING_BACKEND} 改用 Google Directions")
+        return _graph
+
+def routing_requires_api_key():
+    """
+    只有 google 模式一定要 API 金鑰。local / local_first 沒有金鑰時仍可離線規劃，
+    需要改問 Google 的路段（路網查不到或載入失敗）逐段改用直線距離估算；路網載入失敗由 /readyz 回報。
+    """
+    return ROUTING_BACKEND not in ("local", "local_first")
+
+def get_distance_service(api_key):
+    """依 API 金鑰取得共用的 DistanceService（連線池與快取跨請求共用）；路網之後才載入成功時換上路網"""
+    graph = _load_graph()
+    with _services_lock:
+        service = _services.get(api_key)
+        if service is None:
+            service = _services[api_key] = DistanceService(api_key, graph=graph, backend=ROUTING_BACKEND)
+        elif service.graph is None and graph is not None:
+            service.graph, service.backend = graph, ROUTING_BACKEND
+        return service
+
+def warm_routing(api_key):
+    """建立共用的 DistanceService（啟動預熱用）；設定離線路網卻載入失敗時丟出例外，讓 /readyz 回報失敗"""
+    service = get_distance_service(api_key)
+    if ROUTING_BACKEND in ("local", "local_first") and service.graph is None:
+        raise RuntimeError(f"ROUTING_BACKEND={ROUTING_BACKEND}，但校園路網無法載入")
+    return service
+
+def distance_stats():
+    """所有 DistanceService 的快取命中、API 備援與路網查詢次數加總"""
+    with _services_lock:
+        services = list(_services.values())
+    totals = {"hits": 0, "misses": 0, "fallbacks": 0, "local": 0}
+    for service in services:
+        with service._lock:
+            for key in totals:
+                totals[key] += service.stats[key]
+    lookups = totals["hits"] + totals["misses"]
+    totals["hit_rate"] = (totals["hits"] / lookups) if lookups else 0.0
+    return totals
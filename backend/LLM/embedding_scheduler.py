@@ -0,0 +1,98 @@
+# embedding_scheduler.py
+# embedding 微批次排程：把多個同時進來的單筆 embedding 請求在幾毫秒內收集起來，合成一次批次呼叫，
+# 每個呼叫者拿到自己的 Future。模型忙碌時新請求會自然累積成更大的批次。
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+# 收到第一筆請求後最多再等多少毫秒收集其他請求
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+
+class EmbeddingScheduler:
+    """
+    batch_fn 接收 list[str] 回傳同長度的 embedding 清單。
+    單一背景執行緒負責送出批次：上一批還在模型上時，新的請求在佇列中累積成下一批。
+    """
+
+    def __init__(self, batch_fn, max_batch=EMBED_MAX_BATCH, max_wait_ms=EMBED_MAX_WAIT_MS):
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "batches": 0, "largest_batch": 0, "errors": 0}
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="embedding-scheduler", daemon=True)
+                    self._thread.start()
+
+    def submit(self, text) -> Future:
+        """排入一筆文字，回傳之後會得到 embedding 的 Future"""
+        future = Future()
+        self._ensure_started()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text, timeout=None):
+        return self.submit(text).result(timeout)
+
+    def embed_many(self, texts, timeout=None):
+        futures = [self.submit(t) for t in texts]
+        return [f.result(timeout) for f in futures]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                # 期限到了仍把已在佇列中的請求帶走，不讓它們再等一輪
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # 呼叫者已取消的請求不送出
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            with self._stats_lock:
+                self._stats["requests"] += len(batch)
+                self._stats["batches"] += 1
+                self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+            try:
+                vectors = self.batch_fn([text for text, _ in batch])
+                if len(vectors) != len(batch):
+                    raise ValueError(f"embedding 數量不符：送出 {len(batch)} 筆，收到 {len(vectors)} 筆")
+            except Exception as e:
+                logger.error(f"❌ 批次 embedding 失敗：{e}")
+                with self._stats_lock:
+                    self._stats["errors"] += 1
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+    def stats(self):
+        with self._stats_lock:
+            batches = self._stats["batches"]
+            return {
+                **self._stats,
+                "queued": self._queue.qsize(),
+                "avg_batch": (self._stats["requests"] / batches) if batches else 0.0,
+            }
@@ -0,0 +1,18 @@
+# gunicorn.conf.py
+# 正式環境入口：gunicorn -c gunicorn.conf.py app:app
+# 只開一個 worker process，讓 Ollama 閘門、回答快取與特徵快取在所有請求間共用；
+# 以執行緒處理併發，等待 Ollama 的請求由 ollama_gate 控制排隊，超過期限的請求快速回 503。
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5050')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "gthread"
+# 執行緒數需大於 OLLAMA_CONCURRENCY + OLLAMA_QUEUE_SIZE，/compare、/healthz 等請求才不會被排隊中的 /chat 卡住
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+# /chat 串流與自我檢查可能超過一分鐘
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info")
@@ -0,0 +1,135 @@
+# lexical_index.py
+# 規則段落的字詞索引：以中文字元的單字與雙字詞做 BM25，另從（物件）行抽出物品名稱字典。
+# 玩家問題直接點名物品（銅鑰匙、火把、補給站…）時，不必呼叫 embedding 就能找到對應段落；
+# 點名不明確時交回向量檢索，或在 hybrid 模式下與向量排名融合。
+import re
+import math
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+# 倒數排名融合的平滑常數
+RRF_K = 60
+# 點名物品之外的補充段落，BM25 分數需達到點名段落最高分的這個比例，避免塞入不相關的規則
+FILL_RATIO = 0.5
+
+_CATEGORY = re.compile(r"^（[^）]*）")
+_WORD_RUN = re.compile(r"[0-9A-Za-z\u4e00-\u9fff]+")
+# （物件）行的開頭是物品名稱，後面接「是／可以／可／裡面／有」等描述
+_ITEM_NAME = re.compile(r"^（物件）(.{1,10}?)(?:是|可以|可|裡面|有)")
+
+_stats = {"lookups": 0, "lexical_hits": 0, "fallbacks": 0, "builds": 0}
+_stats_lock = threading.Lock()
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+def lexical_stats():
+    """字詞檢索命中（略過 embedding）與退回向量檢索的次數"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["embedding_avoided_ratio"] = round(stats["lexical_hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+    return stats
+
+def tokenize(text):
+    """去掉行首分類標記後，取每段連續中英數字的單字與相鄰雙字"""
+    text = unicodedata.normalize("NFKC", _CATEGORY.sub("", text or "")).lower()
+    tokens = []
+    for run in _WORD_RUN.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+def extract_item_names(paragraphs):
+    """從（物件）段落抽出 {物品名稱: 段落編號}；「普通的史萊姆黏液」也收「普通史萊姆黏液」"""
+    names = {}
+    for pid, paragraph in enumerate(paragraphs):
+        match = _ITEM_NAME.match(paragraph)
+        if not match:
+            continue
+        name = match.group(1).strip()
+        for variant in (name, name.replace("的", "")):
+            if len(variant) >= 2:
+                names.setdefault(variant, pid)
+    return names
+
+def rank_fusion(rankings, k=3, rrf_k=RRF_K):
+    """倒數排名融合：rankings 為多個 [(段落編號, 分數), ...]，回傳融合後前 k 名 [(段落編號, 融合分數)]"""
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, (pid, _) in enumerate(ranking):
+            fused[pid] += 1.0 / (rrf_k + rank + 1)
+    return sorted(fused.items(), key=lambda item: -item[1])[:k]
+
+class LexicalIndex:
+    def __init__(self, paragraphs):
+        self.paragraphs = paragraphs
+        self.item_names = extract_item_names(paragraphs)
+        # 長名稱優先比對，「銅鑰匙碎片」不會被拆成「銅鑰匙」或「鑰匙」
+        self._names_by_length = sorted(self.item_names, key=len, reverse=True)
+        docs = [Counter(tokenize(p)) for p in paragraphs]
+        self._lengths = [sum(doc.values()) for doc in docs]
+        self._avg_length = (sum(self._lengths) / len(docs)) if docs else 0.0
+        self._postings = defaultdict(list)
+        for pid, doc in enumerate(docs):
+            for token, tf in doc.items():
+                self._postings[token].append((pid, tf))
+        n = len(docs)
+        self._idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self._postings.items()}
+        _count("builds")
+
+    def scores(self, query):
+        """回傳 {段落編號: BM25 分數}（只含分數大於 0 的段落）"""
+        scores = defaultdict(float)
+        for token in set(tokenize(query)):
+            idf = self._idf.get(token)
+            if idf is None:
+                continue
+            for pid, tf in self._postings[token]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[pid] / self._avg_length)
+                scores[pid] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query, k=3):
+        """回傳 BM25 前 k 名 [(段落編號, 分數), ...]"""
+        scores = self.scores(query)
+        return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+    def item_hits(self, query):
+        """依出現順序回傳問題中點名的物品段落編號（重疊時只算最長的名稱）"""
+        text = unicodedata.normalize("NFKC", query or "")
+        covered = [False] * len(text)
+        found = []
+        for name in self._names_by_length:
+            start = text.find(name)
+            while start != -1:
+                end = start + len(name)
+                if not any(covered[start:end]):
+                    covered[start:end] = [True] * len(name)
+                    found.append((start, self.item_names[name]))
+                start = text.find(name, end)
+        return list(dict.fromkeys(pid for _, pid in sorted(found)))
+
+    def lookup(self, query, k=3):
+        """
+        有把握時回傳 [(段落編號, 分數), ...]，否則回傳 None 交給向量檢索。
+        有把握：問題點名 1 到 k 個物品；點名的段落排在前面，其餘名額依 BM25 補上分數夠高的段落。
+        """
+        _count("lookups")
+        hits = self.item_hits(query)
+        if not hits or len(hits) > k:
+            _count("fallbacks")
+            return None
+        _count("lexical_hits")
+        scores = self.scores(query)
+        results = [(pid, scores.get(pid, 0.0)) for pid in hits]
+        floor = FILL_RATIO * max(score for _, score in results)
+        for pid, score in sorted(scores.items(), key=lambda item: -item[1]):
+            if len(results) >= k or score < floor:
+                break
+            if pid not in hits:
+                results.append((pid, score))
+        return results
@@ -0,0 +1,179 @@
+# llm_client.py
+# 所有 LLM 呼叫的共用入口：依角色（generate、classify、audit、summary、relevance、embed）選擇模型與逾時，
+# 並記錄耗時與 token 統計。後端可切換：
+#   ollama：共用連線池的 ollama.Client，每次呼叫帶 keep_alive 讓模型常駐
+#   stub：行程內的固定回覆與雜湊向量，不需 Ollama，用於測試與離線執行
+import os
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import ollama
+import numpy as np
+from metrics import OLLAMA_SECONDS, record_ollama
+
+logger = logging.getLogger(__name__)
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "ollama")
+OLLAMA_HOST = os.getenv("OLLAMA_HOST")
+# 預設模型；個別角色可用 OLLAMA_MODEL_<角色> 覆寫，例如分類與自我檢查改用小模型
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "ycchen/breeze-7b-instruct-v1_0")
+ROLES = ("generate", "classify", "relevance", "audit", "summary", "embed")
+# 單次呼叫的逾時秒數（串流時為兩段之間的間隔）；同樣可用 OLLAMA_TIMEOUT_<角色> 覆寫
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "120"))
+# 模型在最後一次呼叫後留在記憶體的時間（Ollama keep_alive 格式，如 30m；-1 表示不卸載）
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# 連線池大小：需涵蓋 OLLAMA_CONCURRENCY 加上背景的分類、摘要與 embedding 呼叫
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "32"))
+
+def _role_setting(prefix, role, default):
+    return os.getenv(f"{prefix}_{role.upper()}", default)
+
+def _keep_alive_value(text):
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+class OllamaBackend:
+    """
+    以 ollama.Client 呼叫 Ollama。逾時是 httpx client 層級的設定，
+    所以每種逾時各建一個 Client，但共用同一個 transport（同一個連線池），連線可跨角色重用。
+    """
+
+    def __init__(self, host=OLLAMA_HOST, max_connections=OLLAMA_MAX_CONNECTIONS):
+        self.host = host
+        self._transport = httpx.HTTPTransport(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+        self._clients = {}
+
+    def _client(self, timeout):
+        client = self._clients.get(timeout)
+        if client is None:
+            client = self._clients.setdefault(timeout, ollama.Client(host=self.host, timeout=timeout, transport=self._transport))
+        return client
+
+    def chat(self, model, messages, stream, keep_alive, timeout, role):
+        return self._client(timeout).chat(model=model, messages=messages, stream=stream, keep_alive=keep_alive)
+
+    @staticmethod
+    def _batch_unsupported(e):
+        """舊版 Ollama 沒有 /api/embed 時回 404 page not found；模型不存在同樣是 404，但訊息會提到 model"""
+        return e.status_code in (404, 405) and "model" not in str(e.error).lower()
+
+    def embed(self, model, texts, keep_alive, timeout):
+        """批次取得 embedding；伺服器不支援 /api/embed 時改為並行呼叫單筆 API，其他錯誤照常丟出"""
+        client = self._client(timeout)
+        try:
+            return list(client.embed(model=model, input=texts, keep_alive=keep_alive)["embeddings"])
+        except ollama.ResponseError as e:
+            if not self._batch_unsupported(e):
+                raise
+            logger.warning(f"Ollama 不支援批次 embedding（{e.error}），改用單筆 API")
+            with ThreadPoolExecutor(max_workers=min(len(texts), 8)) as pool:
+                return list(pool.map(
+                    lambda t: client.embeddings(model=model, prompt=t, keep_alive=keep_alive)["embedding"], texts))
+
+    def preload(self, model, keep_alive, timeout):
+        # 空 prompt 的 /api/generate 只會載入模型
+        self._client(timeout).generate(model=model, prompt="", keep_alive=keep_alive)
+
+# stub 後端的固定回覆：生成內容逐字引用規則，讓本地驗證可判定合格
+STUB_REPLIES = {
+    "generate": "（物件）寶箱是一種物品，可以使用鑰匙解鎖",
+    "classify": "3. 詢問物件",
+    "relevance": "遊戲內問題",
+    "audit": "合格",
+    "summary": "玩家在詢問寶箱與鑰匙的用法",
+}
+
+def stub_vector(text, dim=64):
+    """由文字雜湊決定的固定向量：相同文字得到相同向量"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).normal(size=dim).round(6).tolist()
+
+class StubBackend:
+    """行程內的假後端：chat 依角色回傳 STUB_REPLIES，embedding 回傳雜湊向量；calls 記錄每次呼叫的 (角色, 模型)"""
+
+    def __init__(self, replies=None, dim=64):
+        self.replies = dict(STUB_REPLIES, **(replies or {}))
+        self.dim = dim
+        self.calls = []
+
+    def _response(self, model, content, done=True):
+        return {"model": model, "message": {"role": "assistant", "content": content}, "done": done,
+                "prompt_eval_count": 0, "eval_count": len(content)}
+
+    def chat(self, model, messages, stream, keep_alive, timeout, role):
+        self.calls.append((role, model))
+        content = self.replies.get(role, self.replies["generate"])
+        if not stream:
+            return self._response(model, content)
+        return iter([self._response(model, ch, False) for ch in content] + [self._response(model, "")])
+
+    def embed(self, model, texts, keep_alive, timeout):
+        self.calls.append(("embed", model))
+        return [stub_vector(t, self.dim) for t in texts]
+
+    def preload(self, model, keep_alive, timeout):
+        self.calls.append(("preload", model))
+
+class LLMClient:
+    """依角色選模型與逾時並呼叫後端；chat、chat_stream、embed 都會記錄到 hunter_ollama_* 指標"""
+
+    def __init__(self, backend, default_model=OLLAMA_MODEL, default_timeout=OLLAMA_TIMEOUT,
+                 keep_alive=OLLAMA_KEEP_ALIVE, models=None, timeouts=None):
+        self.backend = backend
+        self.models = {role: _role_setting("OLLAMA_MODEL", role, default_model) for role in ROLES}
+        self.models.update(models or {})
+        self.timeouts = {role: float(_role_setting("OLLAMA_TIMEOUT", role, default_timeout)) for role in ROLES}
+        self.timeouts.update(timeouts or {})
+        self.keep_alive = _keep_alive_value(str(keep_alive))
+
+    def model(self, role):
+        return self.models.get(role, self.models["generate"])
+
+    def _call_args(self, role):
+        return self.model(role), self.timeouts.get(role, self.timeouts["generate"])
+
+    def _chat(self, role, messages, stream):
+        model, timeout = self._call_args(role)
+        return self.backend.chat(model, messages, stream, self.keep_alive, timeout, role)
+
+    def chat(self, role, messages):
+        """回傳完整回覆文字"""
+        with OLLAMA_SECONDS.time(role=role):
+            response = self._chat(role, messages, False)
+        record_ollama(role, response)
+        return response["message"]["content"]
+
+    def chat_stream(self, role, messages):
+        """逐段產生回覆文字；統計取自最後一段"""
+        started = time.perf_counter()
+        last = None
+        for chunk in self._chat(role, messages, True):
+            last = chunk
+            yield chunk["message"]["content"]
+        OLLAMA_SECONDS.observe(time.perf_counter() - started, role=role)
+        record_ollama(role, last)
+
+    def embed(self, texts):
+        model, timeout = self._call_args("embed")
+        with OLLAMA_SECONDS.time(role="embed"):
+            return self.backend.embed(model, texts, self.keep_alive, timeout)
+
+    def preload(self):
+        """把各角色用到的模型載入記憶體（啟動預熱用）"""
+        for model in dict.fromkeys(self.models.values()):
+            self.backend.preload(model, self.keep_alive, self.timeouts["generate"])
+
+def create_backend(name=LLM_BACKEND):
+    if name == "stub":
+        logger.warning("⚠️ LLM_BACKEND=stub：使用行程內的固定回覆，不會呼叫 Ollama")
+        return StubBackend()
+    if name != "ollama":
+        raise ValueError(f"未知的 LLM_BACKEND：{name}")
+    return OllamaBackend()
+
+llm_client = LLMClient(create_backend())
@@ -1,7 +1,21 @@
-import ollama
 import os
+import re
 import json
+import time
+import hashlib
+import threading
+import unicodedata
 import numpy as np
+from embedding_scheduler import EmbeddingScheduler, EMBED_MAX_BATCH
+from llm_client import llm_client
+
+def llm_chat(role, messages):
+    """依角色（classify、generate、audit、summary 等）選用模型呼叫 LLM，回傳回覆文字"""
+    return llm_client.chat(role, messages)
+
+def llm_chat_stream(role, messages):
+    """串流版 llm_chat，逐段產生文字"""
+    return llm_client.chat_stream(role, messages)
 
 def get_self_check_prompt(question_type, response):
     base_intro = (
@@ -88,34 +102,183 @@ def parse_paragraph(filename, max_length=300):
         paragraphs.append(" ".join(current_paragraph))
     return paragraphs
 
-def calc_embeddings(paragraphs, max_tokens=400):
-    """計算遊戲規則的向量嵌入，長段落自動分割"""
-    embeddings = []
-    for para in paragraphs:
+EMBEDDING_MODEL = llm_client.model("embed")
+# 內容定址的 embedding 快取目錄：vectors.npy + manifest.json
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "cache/embeddings")
+# 每次批次送出的文字數
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))
+# 超過這麼久（秒）沒被用到的向量在下次寫回快取時移除（規則改寫、換模型後留下的舊片段）
+EMBEDDING_CACHE_MAX_AGE = float(os.getenv("EMBEDDING_CACHE_MAX_AGE", str(30 * 86400)))
+
+def split_chunks(paragraphs, max_tokens=400):
+    """把段落切成不超過 max_tokens 字的片段，回傳 (片段列表, 每個片段所屬的段落編號)"""
+    chunks, owners = [], []
+    for pid, para in enumerate(paragraphs):
         # 若段落太長，分割多次嵌入
-        if len(para) > max_tokens:
-            for i in range(0, len(para), max_tokens):
-                sub_para = para[i:i+max_tokens]
-                embedding = ollama.embeddings(model="ycchen/breeze-7b-instruct-v1_0", prompt=sub_para)["embedding"]
-                embeddings.append(embedding)
-        else:
-            embedding = ollama.embeddings(model="ycchen/breeze-7b-instruct-v1_0", prompt=para)["embedding"]
-            embeddings.append(embedding)
-    return embeddings
+        pieces = [para[i:i+max_tokens] for i in range(0, len(para), max_tokens)] if len(para) > max_tokens else [para]
+        chunks.extend(pieces)
+        owners.extend([pid] * len(pieces))
+    return chunks, owners
+
+def embed_batch(texts, batch_size=EMBEDDING_BATCH_SIZE):
+    """以 embed 角色的模型分批取得 embedding"""
+    vectors = []
+    for i in range(0, len(texts), batch_size):
+        vectors.extend(llm_client.embed(texts[i:i+batch_size]))
+    return vectors
+
+# 所有單筆 embedding（玩家問題、路線意圖）共用的微批次排程
+embedding_scheduler = EmbeddingScheduler(lambda texts: embed_batch(texts, EMBED_MAX_BATCH))
+
+class EmbeddingStore:
+    """
+    以（模型名稱、文字內容）的雜湊為鍵的 embedding 快取。
+    只對新增或內容改變的文字呼叫 embedding，向量以 float32 存成 vectors.npy，對照表存在 manifest.json。
+    manifest 記錄每個雜湊最近被用到的時間（隨寫回更新），寫回時移除超過 max_age 沒用到的向量。
+    """
+
+    def __init__(self, directory=EMBEDDING_CACHE_DIR, model=EMBEDDING_MODEL, max_age=EMBEDDING_CACHE_MAX_AGE):
+        self.directory = directory
+        self.model = model
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._rows = None      # 雜湊 -> vectors 的列號
+        self._used = {}        # 雜湊 -> 最後用到的時間
+        self._vectors = None
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _digest(vectors):
+        return hashlib.sha1(np.ascontiguousarray(vectors).tobytes()).hexdigest()
+
+    def _load(self):
+        if self._rows is not None:
+            return
+        manifest_path = os.path.join(self.directory, "manifest.json")
+        vectors_path = os.path.join(self.directory, "vectors.npy")
+        self._rows, self._used, self._vectors = {}, {}, None
+        if os.path.isfile(manifest_path) and os.path.isfile(vectors_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            vectors = np.load(vectors_path)
+            # 兩個行程同時寫回時 vectors 與 manifest 可能來自不同次寫入，摘要不符就當作沒有快取
+            digest = manifest.get("digest")
+            if vectors.shape[0] == len(manifest["rows"]) and (digest is None or digest == self._digest(vectors)):
+                now = time.time()
+                self._rows = manifest["rows"]
+                self._used = {key: manifest.get("used", {}).get(key, now) for key in self._rows}
+                self._vectors = vectors
+
+    def _prune(self):
+        """移除超過 max_age 沒用到的向量，並把剩下的列重新排成連續的矩陣"""
+        cutoff = time.time() - self.max_age
+        keep = [key for key in self._rows if self._used.get(key, 0) >= cutoff]
+        if len(keep) == len(self._rows):
+            return
+        self._vectors = self._vectors[[self._rows[key] for key in keep]]
+        self._rows = {key: row for row, key in enumerate(keep)}
+        self._used = {key: self._used[key] for key in keep}
+
+    @staticmethod
+    def _replace(path, write):
+        """先寫行程與執行緒專屬的暫存檔再 os.replace，多個 worker 同時寫回也不會互相覆蓋暫存檔"""
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                write(f)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _save(self):
+        self._prune()
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = {"model": self.model, "rows": self._rows, "used": self._used, "digest": self._digest(self._vectors)}
+        # 先換上向量再換 manifest：讀取端看到新的 manifest 時向量一定已經就位
+        self._replace(os.path.join(self.directory, "vectors.npy"), lambda f: np.save(f, self._vectors))
+        self._replace(os.path.join(self.directory, "manifest.json"),
+                      lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+
+    def get_many(self, texts):
+        """回傳 (len(texts), D) 的 float32 矩陣，缺少的向量批次補算後寫回快取"""
+        keys = [self._key(t) for t in texts]
+        with self._lock:
+            self._load()
+            now = time.time()
+            missing = {}
+            for key, text in zip(keys, texts):
+                self._used[key] = now
+                if key not in self._rows and key not in missing:
+                    missing[key] = text
+            if missing:
+                fresh = np.asarray(embed_batch(list(missing.values())), dtype=np.float32)
+                start = 0 if self._vectors is None else self._vectors.shape[0]
+                self._vectors = fresh if self._vectors is None else np.concatenate([self._vectors, fresh], axis=0)
+                for offset, key in enumerate(missing):
+                    self._rows[key] = start + offset
+                self._save()
+            if not keys:
+                return np.empty((0, 0 if self._vectors is None else self._vectors.shape[1]), dtype=np.float32)
+            return self._vectors[[self._rows[k] for k in keys]]
+
+embedding_store = EmbeddingStore()
+
+def calc_embeddings(paragraphs, max_tokens=400):
+    """計算遊戲規則的向量嵌入，長段落自動分割；已算過的片段直接從快取取用"""
+    chunks, _ = split_chunks(paragraphs, max_tokens)
+    return embedding_store.get_many(chunks)
 
 def cache_embeddings(filename, paragraphs):
-    """將規則的嵌入結果緩存到檔案"""
-    embedding_file = f"cache/{filename}.json"
-    if os.path.isfile(embedding_file):
-        with open(embedding_file) as f:
-            cached_data = json.load(f)
-            if len(cached_data) == len(paragraphs):
-                return cached_data
-    os.makedirs("cache", exist_ok=True)
-    embeddings = calc_embeddings(paragraphs)
-    with open(embedding_file, "w") as f:
-        json.dump(embeddings, f)
-    return embeddings
+    """
+    將規則的嵌入結果緩存到檔案。
+    快取以片段內容定址，修改 rule.txt 的某一行只會重算該段；filename 僅為相容舊介面保留。
+    """
+    return calc_embeddings(paragraphs)
+
+class RetrievalIndex:
+    """
+    規則段落的檢索索引：片段向量事先正規化成 float32 矩陣，並記錄每個片段屬於哪個段落。
+    查詢時以段落內最高的片段分數作為段落分數，用 argpartition 取前 k 名，可一次查詢多個向量。
+    """
+
+    def __init__(self, paragraphs, vectors, owners):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.paragraphs = paragraphs
+        self.matrix = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-8)
+        self.owners = np.asarray(owners, dtype=np.int64)
+        # split_chunks 依段落順序產生片段，同一段落的片段必定相鄰
+        self._starts = np.flatnonzero(np.r_[True, self.owners[1:] != self.owners[:-1]])
+        self._paragraph_ids = self.owners[self._starts]
+
+    @classmethod
+    def build(cls, paragraphs, max_tokens=400):
+        chunks, owners = split_chunks(paragraphs, max_tokens)
+        return cls(paragraphs, embedding_store.get_many(chunks), owners)
+
+    def paragraph_scores(self, queries):
+        """queries (B, D) 或 (D,)；回傳 (B, 段落數) 的餘弦分數"""
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        q = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-8)
+        chunk_scores = q @ self.matrix.T  # (B, 片段數)
+        return np.maximum.reduceat(chunk_scores, self._starts, axis=1)
+
+    def search(self, queries, k=3):
+        """
+        回傳 [(段落編號, 分數), ...]（依分數由高到低）。
+        傳入單一向量時回傳一個列表，傳入多個向量時回傳每個查詢的列表。
+        """
+        single = np.asarray(queries).ndim == 1
+        scores = self.paragraph_scores(queries)
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, cand in zip(scores, top):
+            cand = cand[np.argsort(-row[cand])]
+            results.append([(int(self._paragraph_ids[c]), float(row[c])) for c in cand])
+        return results[0] if single else results
 
 def calc_similar_vectors(v, vectors):
     """計算與輸入向量最相似的規則"""
@@ -136,10 +299,7 @@ def check_if_question_is_game_related(user_input):
         "如果問題與遊戲規則有關，請回答「遊戲內問題」。\n"
         "如果問題與遊戲規則無關，請回答「遊戲外問題」。"
     )
-    response = ollama.chat(
-        model="ycchen/breeze-7b-instruct-v1_0",
-        messages=[{"role": "user", "content": check_prompt}],
-    )["message"]["content"]
+    response = llm_chat("relevance", [{"role": "user", "content": check_prompt}])
     return response.strip()
 
 def classify_question_type(user_input):
@@ -154,7 +314,7 @@ def classify_question_type(user_input):
         f"{user_input}\n=== 結束 ===\n\n"
         "請直接回答分類編號與說明，例如「3. 詢問物件」。"
     )
-    response = ollama.chat(model="ycchen/breeze-7b-instruct-v1_0", messages=[{"role": "user", "content": prompt}])["message"]["content"]
+    response = llm_chat("classify", [{"role": "user", "content": prompt}])
     if "1" in response:
         return "greeting"
     elif "2" in response:
@@ -166,6 +326,218 @@ def classify_question_type(user_input):
     else:
         return "other"
 
+# 固定回覆：與 build_instance_adaptive_prompt 中規定的內容一致
+CANNED_REPLIES = {
+    "greeting": "嗨！歡迎來到海大尋寶地圖遊戲",
+    "thanks": "不客氣！",
+    "off_topic": "我不清楚遊戲以外的內容。",
+    "language": "我只能使用繁體中文回應你。",
+}
+# 本地意圖對應到 classify_question_type 的分類
+_INTENT_TO_QUESTION_TYPE = {"greeting": "greeting", "thanks": "greeting", "off_topic": "off_topic", "language": "off_topic"}
+
+_GREETING_PATTERN = re.compile(r"^(關主)?(嗨+|哈+囉|哈摟|你好|您好|大家好|嘿+|安安|早安|午安|晚安|早|哈嘍)(關主|呀|啊|啦|喔|哦|你好)?$")
+# 英文打招呼與要求翻譯、改用其他語言：依規則只能回覆「我只能使用繁體中文回應你。」
+_ENGLISH_GREETING_PATTERN = re.compile(r"^(關主)?(hi+|hello|hey|halo)(關主)?$")
+_LANGUAGE_PATTERN = re.compile(r"(翻譯|翻成|譯成|英文|英語|日文|日語|韓文|韓語|簡體|簡中|english|translate)")
+_THANKS_PATTERN = re.compile(r"^(謝謝|謝啦|謝囉|感謝|多謝|感恩|thanks?|thankyou|thx|3q)(你|您|關主|啦|喔|囉)*$")
+_OFF_TOPIC_PATTERN = re.compile(
+    r"(天氣|氣溫|股票|股價|新聞|總統|選舉|政治|電影|歌詞|食譜|晚餐吃|作業|寫程式|程式碼|python|java|寫一首|寫一篇|"
+    r"幾點|今天幾號|星期幾|匯率|[0-9]+\s*[+\-*/x×÷]\s*[0-9]+)"
+)
+# 出現任何遊戲用語就交給 LLM 判斷，避免把遊戲問題誤判為無關問題
+_GAME_TERMS = (
+    "遊戲", "任務", "路線", "規則", "鑰匙", "寶箱", "碎片", "史萊姆", "黏液", "地圖", "寶藏", "刷新", "火把", "古樹",
+    "收藏", "背包", "排行", "補給", "設定", "等級", "積分", "道具", "合成", "打卡", "地標", "事件", "關主", "獎勵",
+    "分數", "得分", "海大",
+)
+_PUNCT = re.compile(r"[\s\?？!！。．\.,，、~～…:：;；]+")
+
+def local_classify_question(user_input):
+    """
+    以關鍵字／正規表達式判斷打招呼、道謝、要求其他語言與明顯無關的問題（不呼叫 LLM）。
+    回傳 greeting / thanks / language / off_topic，無法確定時回傳 None。
+    """
+    text = _PUNCT.sub("", unicodedata.normalize("NFKC", user_input or "").lower())
+    if not text:
+        return None
+    # 要求其他語言時即使提到遊戲用語也一律拒絕
+    if _ENGLISH_GREETING_PATTERN.match(text) or _LANGUAGE_PATTERN.search(text):
+        return "language"
+    if _GREETING_PATTERN.match(text):
+        return "greeting"
+    if _THANKS_PATTERN.match(text):
+        return "thanks"
+    if not any(term in text for term in _GAME_TERMS) and _OFF_TOPIC_PATTERN.search(text):
+        return "off_topic"
+    return None
+
+# 意圖範例句檔：{意圖: [範例句, ...]}
+INTENT_EXEMPLARS_FILE = os.getenv("INTENT_EXEMPLARS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "intent_exemplars.json"))
+
+class IntentBank:
+    """
+    意圖範例句庫：範例句的 embedding 只算一次（透過 embedding_store 快取到磁碟），保存為正規化矩陣。
+    一個問題 embedding 與矩陣做一次內積，就能得到每個意圖的最高分數。
+    """
+
+    def __init__(self, exemplars):
+        self.exemplars = exemplars
+        self.intents = list(exemplars)
+        self._matrix = None
+        self._starts = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path=INTENT_EXEMPLARS_FILE):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def _ensure_matrix(self):
+        if self._matrix is None:
+            with self._lock:
+                if self._matrix is None:
+                    phrases = [p for intent in self.intents for p in self.exemplars[intent]]
+                    vectors = np.array(embedding_store.get_many(phrases), dtype=np.float32)
+                    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-8)
+                    self._starts = np.cumsum([0] + [len(self.exemplars[i]) for i in self.intents[:-1]])
+                    self._matrix = vectors
+        return self._matrix
+
+    def warm(self):
+        """預先算好範例句矩陣（啟動預熱用）"""
+        self._ensure_matrix()
+
+    def scores(self, embedding):
+        """回傳 {意圖: 與該意圖範例句的最高餘弦分數}"""
+        matrix = self._ensure_matrix()
+        v = np.asarray(embedding, dtype=np.float32)
+        sims = matrix @ (v / max(float(np.linalg.norm(v)), 1e-8))
+        best = np.maximum.reduceat(sims, self._starts)
+        return {intent: float(score) for intent, score in zip(self.intents, best)}
+
+intent_bank = IntentBank.from_file()
+
+# 可以直接回覆固定內容的意圖；其餘意圖（路線、任務、規則）命中時交回 LLM
+_CANNED_INTENTS = ("greeting", "thanks", "off_topic", "language")
+
+def classify_by_exemplars(embedding=None, threshold=0.85, margin=0.05, scores=None):
+    """
+    以問題的 embedding 與範例句做最近鄰判斷（可直接傳入 intent_bank.scores 的結果，避免重算）。
+    最接近的是 greeting / thanks / off_topic / language 且分數夠高、與其他意圖拉開差距時回傳該意圖，否則回傳 None。
+    """
+    if scores is None:
+        scores = intent_bank.scores(embedding)
+    intent = max(scores, key=scores.get)
+    if intent not in _CANNED_INTENTS or scores[intent] < threshold:
+        return None
+    other_best = max((s for i, s in scores.items() if i not in _CANNED_INTENTS), default=-1.0)
+    if scores[intent] - other_best < margin:
+        return None
+    return intent
+
+def canned_reply(intent):
+    """回傳 (question_type, 固定回覆)"""
+    return _INTENT_TO_QUESTION_TYPE[intent], CANNED_REPLIES[intent]
+
+# === 自我檢查前的本地驗證：能機械判斷的規則直接判定，判斷不了的才交給 LLM 稽核 ===
+# 常用的簡體專用字（繁體中文不會出現）
+_SIMPLIFIED_ONLY = frozenset(
+    "这们个来时会对过还没发问题间门开关给让应该为经线点图获处现样动学长东车书见观历认识讲语谁请读写买卖乐专业两严丢亚产亲亿仅从众优传伤价举乡争亏圣场坏块坚备复够头夺"
+    "奋妈孙实宝宠审寻导将尘尽层属岁岛币帅师帐带帮广库庙废异张弹归当录彻径忆忧怀态总恋恶悬惊惧惯愿战执扩扫扬护报担拟拥拦择挂挡挤挥损换据无旧显晒晓暂术机杀杂权条杨极构"
+    "枪柜标栏树桥检楼欢毁毕气汇汉汤沟沪泪泽洁浅测济浏浓润涨渐湾满灭灯灵灾炉烟热爱爷牵犹独狮猎环电画畅疗盖监盘矿码确碍礼离积称稳穷竞笔笼简类粮紧纠红约级纪纯纲纳纵纸纹"
+    "练组细织终绍结绕绘络绝统继绩绪续维综绿编缘网罗罚职联聪肃胁胜脑脚脱舰艺节芦苏荣药莱虽虾蚁蛮补袭装规视览觉誉计订讨训议讯记许论设访证评诉词译试诗诚话询详误说诸课调"
+    "谈谋谢谱负贡财责败货质贩购贯贵费贴贸资赏赔赖赚赛赞赢赶趋跃践踪轨转轮软轻载较辅辆辉辑输辞边达迁运进远违连迟选递逻遗邮邻郑酱释钟钢钥钱铁铃铜银铺链销锁锅错锦键镇镜"
+    "闪闭闯闲闹闻阅队阳阴阵阶际陆陈险随隐难雾韩页顶项顺须顾顿预领频颜额风飞饭饮饰饱馆马驾验骑鱼鲁鸟鸡鸣麦龙龟齐齿么仓伞侦俭债偿储兑兽况冻净减击刘则刚创删别剂剑剧劝办"
+    "务劳势勋区医华协单卢卫却厅压厌厕县参双变叙叹吓吗启员呜响唤喷团园围国圆垄墙壮声壳夹奖妇娱婴宪宽宾寿岗帘帜庄庆弃弯恳恼悦惩戏扑扰抚抢拣拨挣捡掷揽携摄摆摇敌数斋断晋"
+    "晕枣枫栋桩梦椭歼毙汹沦沧泻泼洒浆浇浊浑涛涡涩渊渔渗湿溃滚滤滥滩潜灿炼烁烂烛烧狭狱献玛琐疮疯痒瘫盏盐盗矫砖础硕祸秃窃窍窝竖筑筹签纤纱纷纺绅绊绎绑绒绢绣绰绳绵绸缀缓"
+    "缝缠缩"
+)
+_ENGLISH_WORD = re.compile(r"[A-Za-z]{2,}")
+_UNKNOWN_REPLY = "我不清楚遊戲以外的內容"
+_LANGUAGE_REFUSAL = "我只能使用繁體中文回應你"
+# 各分類回覆只能是固定內容（比對時忽略標點與空白）
+_EXACT_TEMPLATES = {
+    "greeting": (CANNED_REPLIES["greeting"], CANNED_REPLIES["thanks"]),
+    "off_topic": (_UNKNOWN_REPLY, _LANGUAGE_REFUSAL),
+}
+# 本地可直接接受「我不清楚遊戲以外的內容」的分類；其他分類只有沒檢索到規則段落時才接受
+_REFUSAL_TYPES = ("off_topic", "other")
+# 需逐字引用規則原文的分類；回覆中以 n 字片段計算被規則原文覆蓋的比例
+_VERBATIM_TYPES = ("mission_request", "rule_query")
+_VERBATIM_NGRAM = 4
+VERBATIM_ACCEPT_RATIO = float(os.getenv("VERBATIM_ACCEPT_RATIO", "0.9"))
+
+def _strip_punct(text):
+    return _PUNCT.sub("", unicodedata.normalize("NFKC", text or ""))
+
+def verbatim_ratio(response, rule_paragraphs, n=_VERBATIM_NGRAM):
+    """回覆中有多少比例的字落在與規則原文相同的 n 字片段內"""
+    text = _strip_punct(response)
+    if len(text) < n:
+        return 0.0
+    source = _strip_punct("".join(rule_paragraphs))
+    grams = {source[i:i + n] for i in range(len(source) - n + 1)}
+    covered = [False] * len(text)
+    for i in range(len(text) - n + 1):
+        if text[i:i + n] in grams:
+            covered[i:i + n] = [True] * n
+    return sum(covered) / len(text)
+
+class ResponseValidator:
+    """
+    依序檢查：英文、簡體字、固定回覆範本、「我不清楚遊戲以外的內容」後面加話、逐字引用規則。
+    validate 回傳 (True, None) 合格、(False, 原因) 不合格、(None, None) 無法判斷需交給 LLM 稽核。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"passed": 0, "failed": 0, "deferred": 0}
+
+    def _decide(self, verdict, reason=None):
+        key = "deferred" if verdict is None else ("passed" if verdict else "failed")
+        with self._lock:
+            self._stats[key] += 1
+        return verdict, reason
+
+    def validate(self, question_type, response, rule_paragraphs=()):
+        text = (response or "").strip()
+        if not text:
+            return self._decide(False, "回覆為空")
+        rules_text = " ".join(rule_paragraphs).lower()
+        # 規則原文中出現的英文（例如 NPC）不算違規
+        words = [w for w in _ENGLISH_WORD.findall(unicodedata.normalize("NFKC", text)) if w.lower() not in rules_text]
+        if words:
+            return self._decide(False, "禁止使用英文")
+        if any(ch in _SIMPLIFIED_ONLY for ch in text):
+            return self._decide(False, "禁止使用簡體中文")
+        stripped = _strip_punct(text)
+        # 固定回覆的分類先比對範本，逐字相符就不必再做其他檢查
+        templates = _EXACT_TEMPLATES.get(question_type)
+        if templates is not None and stripped in {_strip_punct(t) for t in templates}:
+            return self._decide(True)
+        if _UNKNOWN_REPLY in stripped:
+            if stripped == _UNKNOWN_REPLY:
+                # 規則問題已檢索到段落卻拒答，可能是生成失誤，交給 LLM 稽核（通過的答案會被快取）
+                if question_type in _REFUSAL_TYPES or not rule_paragraphs:
+                    return self._decide(True)
+                return self._decide(None)
+            return self._decide(False, "「我不清楚遊戲以外的內容。」後面禁止再加上其他東西")
+        if templates is not None:
+            return self._decide(False, "只能回覆固定內容，禁止任何額外說明")
+        if question_type in _VERBATIM_TYPES and rule_paragraphs:
+            if verbatim_ratio(text, rule_paragraphs) >= VERBATIM_ACCEPT_RATIO:
+                return self._decide(True)
+        return self._decide(None)
+
+    def stats(self):
+        with self._lock:
+            decided = self._stats["passed"] + self._stats["failed"]
+            total = decided + self._stats["deferred"]
+            return {**self._stats, "audits_avoided": decided, "avoided_rate": (decided / total) if total else 0.0}
+
+response_validator = ResponseValidator()
+
 def build_instance_adaptive_prompt(paragraphs, valid_vectors, question_type, memory_summary=None):
     # 僅取最相關的規則段落
     rules = "\n".join(paragraphs[v[0]] for v in valid_vectors)
@@ -215,22 +587,67 @@ def build_instance_adaptive_prompt(paragraphs, valid_vectors, question_type, mem
             "遊戲規則如下：\n" + rules
         )
 
-def summarize_conversation(conversation_history):
+def summarize_conversation(conversation_history, previous_summary=None):
+    """總結對話；有 previous_summary 時只把新訊息併入既有摘要"""
     summary_prompt = (
         "請根據以下對話，整理玩家目前的問題主題或背景，例如他在問某個物件、任務，或正在進行某件事。\n"
         "只要簡單一到兩句話即可，用於理解接下來的問題上下文。\n"
-        "=== 對話歷史 ===\n"
     )
+    if previous_summary:
+        summary_prompt += f"=== 先前的對話摘要 ===\n{previous_summary}\n=== 新的對話 ===\n"
+    else:
+        summary_prompt += "=== 對話歷史 ===\n"
     for msg in conversation_history:
         if msg["role"] != "system":
             summary_prompt += f'{msg["role"]}: {msg["content"]}\n'
     summary_prompt += "=== 結束 ===\n請總結："
 
-    result = ollama.chat(
-        model="ycchen/breeze-7b-instruct-v1_0",
-        messages=[{"role": "user", "content": summary_prompt}]
-    )["message"]["content"]
+    result = llm_chat("summary", [{"role": "user", "content": summary_prompt}])
     return result.strip()
 
+_CJK_CHAR = re.compile(r"[\u3000-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+def estimate_tokens(text):
+    """粗估 token 數：中日文字元每字約一個 token，其餘約四個字元一個 token"""
+    text = text or ""
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def estimate_messages_tokens(messages):
+    # 每則訊息另加少量角色標記的開銷
+    return sum(estimate_tokens(m.get("content", "")) + 4 for m in messages)
+
+# 送給生成模型的對話歷史上限（估計 token 數）；超過時較舊的訊息改由 session 摘要代替。
+# 預設與 CHAT_SUMMARY_TOKEN_BUDGET 相同：歷史放得下時不會產生摘要，放不下時才有摘要可以補上
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "400"))
+
+def select_recent_turns(conversation_history, budget=CHAT_HISTORY_TOKEN_BUDGET):
+    """
+    從最新的訊息往前保留，直到超過 budget；回傳 (保留的訊息, 捨棄的則數)。
+    最後一則（本次提問）一定保留，即使它本身就超過預算。
+    """
+    kept, used = [], 0
+    for message in reversed(conversation_history):
+        cost = estimate_messages_tokens([message])
+        if kept and used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    return kept, len(conversation_history) - len(kept)
+
+def assemble_chat_messages(system_prompt, recent_turns, memory_summary=None, retry_hint=None):
+    """
+    組出送給生成模型的訊息。system 訊息以指示與規則段落開頭，同一題的每次重試都相同，
+    Ollama 可以重用這段前綴的計算結果；摘要與重試提示這些每次不同的內容放在它後面。
+    """
+    content = system_prompt
+    if memory_summary:
+        content += f"\n\n【對話記憶】：{memory_summary}"
+    if retry_hint:
+        content += f"\n\n{retry_hint}"
+    return [{"role": "system", "content": content}] + list(recent_turns)
+
 def embed(text):
-    return ollama.embeddings(model="ycchen/breeze-7b-instruct-v1_0", prompt=text)["embedding"]
+    """單筆 embedding；經由微批次排程，與同時進來的其他請求合併成一次批次呼叫"""
+    return embedding_scheduler.embed(text)
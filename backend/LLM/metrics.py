@@ -0,0 +1,178 @@
+# metrics.py
+# 行程內的輕量指標：直方圖、計數器與由各模組 stats() 轉成的量測值，輸出 Prometheus 文字格式給 /metrics。
+# 每次記錄只是加鎖後更新幾個數字，可在正式環境常開。
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# 秒數直方圖的預設分界：涵蓋毫秒級的本地運算到數十秒的 LLM 生成
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+_registry = []
+_stats_sources = []
+_registry_lock = threading.Lock()
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines, cumulative = [], 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+def register_stats(prefix, fn, help_text=""):
+    """把回傳 dict 的 stats() 函式登記為量測值；每個數值欄位輸出成 {prefix}_{欄位}"""
+    with _registry_lock:
+        _stats_sources.append((prefix, fn, help_text))
+
+def render():
+    """輸出 Prometheus 文字格式"""
+    with _registry_lock:
+        metrics = list(_registry)
+        sources = list(_stats_sources)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    for prefix, fn, help_text in sources:
+        try:
+            stats = fn()
+        except Exception:
+            continue
+        for key, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f"{prefix}_{key}"
+            lines.append(f"# HELP {name} {help_text or prefix} {key}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+# === 各模組共用的指標 ===
+CHAT_STAGE_SECONDS = Histogram(
+    "hunter_chat_stage_seconds", "Chat pipeline stage latency", ("stage", "question_type"))
+CHAT_REQUEST_SECONDS = Histogram(
+    "hunter_chat_request_seconds", "End-to-end chat latency by outcome", ("outcome", "question_type"))
+CHAT_ATTEMPTS = Histogram(
+    "hunter_chat_attempts", "Generation attempts per answered chat (self-check retries + 1)", ("question_type",),
+    buckets=(1, 2, 3, 4))
+CHAT_PROMPT_TOKENS = Histogram(
+    "hunter_chat_prompt_tokens", "Estimated generation prompt size: as sent vs. with the full client history",
+    ("kind",), buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 16000))
+CHAT_HISTORY_DROPPED = Counter(
+    "hunter_chat_history_dropped_total", "History messages left out of the prompt and covered by the session summary")
+SELF_CHECK_TOTAL = Counter(
+    "hunter_self_check_total", "Self-check verdicts by source", ("source", "verdict", "question_type"))
+OLLAMA_SECONDS = Histogram(
+    "hunter_ollama_seconds", "Ollama call wall time by role", ("role",))
+OLLAMA_PROMPT_TOKENS = Counter(
+    "hunter_ollama_prompt_tokens_total", "Prompt tokens evaluated by Ollama", ("role",))
+OLLAMA_EVAL_TOKENS = Counter(
+    "hunter_ollama_eval_tokens_total", "Tokens generated by Ollama", ("role",))
+OLLAMA_EVAL_SECONDS = Counter(
+    "hunter_ollama_eval_seconds_total", "Ollama generation time reported by the server", ("role",))
+OLLAMA_PROMPT_EVAL_SECONDS = Counter(
+    "hunter_ollama_prompt_eval_seconds_total", "Ollama prompt evaluation time reported by the server", ("role",))
+OLLAMA_LOAD_SECONDS = Counter(
+    "hunter_ollama_load_seconds_total", "Ollama model load time reported by the server", ("role",))
+DIRECTIONS_SECONDS = Histogram(
+    "hunter_directions_seconds", "Google Directions API latency", ("status",))
+HTTP_REQUEST_SECONDS = Histogram(
+    "hunter_http_request_seconds", "HTTP handler latency", ("endpoint", "method", "status"))
+
+def _field(response, name):
+    try:
+        return response.get(name)
+    except AttributeError:
+        return getattr(response, name, None)
+
+def record_ollama(role, response):
+    """從 Ollama 回應（或串流最後一段）取出 token 數與伺服器端耗時（奈秒）"""
+    if response is None:
+        return
+    prompt_tokens = _field(response, "prompt_eval_count")
+    eval_tokens = _field(response, "eval_count")
+    if prompt_tokens:
+        OLLAMA_PROMPT_TOKENS.inc(prompt_tokens, role=role)
+    if eval_tokens:
+        OLLAMA_EVAL_TOKENS.inc(eval_tokens, role=role)
+    for field, counter in (("eval_duration", OLLAMA_EVAL_SECONDS),
+                           ("prompt_eval_duration", OLLAMA_PROMPT_EVAL_SECONDS),
+                           ("load_duration", OLLAMA_LOAD_SECONDS)):
+        value = _field(response, field)
+        if value:
+            counter.inc(value / 1e9, role=role)
+
+def observe_future(stage, future, started, **labels):
+    """並行階段完成時記錄從送出到完成的時間"""
+    future.add_done_callback(lambda _: CHAT_STAGE_SECONDS.observe(time.monotonic() - started, stage=stage, **labels))
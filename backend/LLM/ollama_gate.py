@@ -0,0 +1,88 @@
+# ollama_gate.py
+# 全域的 Ollama 併發閘門：同時只讓固定數量的請求使用本機模型，其餘在有上限的佇列中等待；
+# 佇列已滿或預估等待會超過期限時立刻拒絕，由 app 回傳 503 + Retry-After。
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "2"))
+OLLAMA_QUEUE_SIZE = int(os.getenv("OLLAMA_QUEUE_SIZE", "16"))
+# 在佇列中最多等待的秒數
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "30"))
+
+class Overloaded(Exception):
+    """佇列已滿或等待逾時；retry_after 為建議重試秒數"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class OllamaGate:
+    def __init__(self, concurrency=OLLAMA_CONCURRENCY, queue_size=OLLAMA_QUEUE_SIZE, timeout=OLLAMA_QUEUE_TIMEOUT):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        # 每個請求佔用名額的平均秒數（指數移動平均），用來預估等待時間
+        self._hold_seconds = None
+        self._stats = {"admitted": 0, "rejected": 0, "timeouts": 0}
+
+    def _estimated_wait(self, position):
+        if self._hold_seconds is None:
+            return 0.0
+        return self._hold_seconds * math.ceil(position / self.concurrency)
+
+    def _retry_after(self):
+        return max(1, int(math.ceil(self._estimated_wait(self._waiting + 1) or 1)))
+
+    def _reject(self, message, stat):
+        self._stats[stat] += 1
+        raise Overloaded(message, self._retry_after())
+
+    @contextmanager
+    def slot(self):
+        """取得一個 Ollama 名額；無法在期限內取得時丟出 Overloaded"""
+        with self._cond:
+            if self._active >= self.concurrency:
+                if self._waiting >= self.queue_size:
+                    self._reject("等待佇列已滿", "rejected")
+                if self._estimated_wait(self._waiting + 1) > self.timeout:
+                    self._reject("預估等待時間超過期限", "rejected")
+                deadline = time.monotonic() + self.timeout
+                self._waiting += 1
+                try:
+                    while self._active >= self.concurrency:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject("等待逾時", "timeouts")
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._active += 1
+            self._stats["admitted"] += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            held = time.monotonic() - started
+            with self._cond:
+                self._active -= 1
+                self._hold_seconds = held if self._hold_seconds is None else 0.8 * self._hold_seconds + 0.2 * held
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                **self._stats,
+                "active": self._active,
+                "queue_depth": self._waiting,
+                "concurrency": self.concurrency,
+                "queue_size": self.queue_size,
+                "avg_hold_seconds": round(self._hold_seconds, 3) if self._hold_seconds is not None else None,
+            }
+
+ollama_gate = OllamaGate()
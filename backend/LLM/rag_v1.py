@@ -1,18 +1,39 @@
-import ollama
 import json
 import os
+import time
+import hashlib
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
 from llm_utils import (
     get_self_check_prompt,
     parse_paragraph,
-    cache_embeddings,
-    calc_similar_vectors,
+    RetrievalIndex,
     classify_question_type,
     build_instance_adaptive_prompt,
-    summarize_conversation,
+    select_recent_turns,
+    assemble_chat_messages,
+    estimate_messages_tokens,
+    local_classify_question,
+    classify_by_exemplars,
+    intent_bank,
+    canned_reply,
+    embedding_scheduler,
+    response_validator,
+    llm_chat,
+    llm_chat_stream,
 )
 from route_utils import detect_route_intent, generate_route_from_start
+from distance_service import routing_requires_api_key
+from chat_cache import answer_cache, file_version
+from session_memory import session_summaries
+from ollama_gate import ollama_gate, Overloaded
+from lexical_index import LexicalIndex, rank_fusion
+from metrics import (
+    CHAT_STAGE_SECONDS, CHAT_REQUEST_SECONDS, CHAT_ATTEMPTS, SELF_CHECK_TOTAL, CHAT_PROMPT_TOKENS, CHAT_HISTORY_DROPPED,
+    observe_future,
+)
 
 load_dotenv()
 
@@ -23,114 +44,339 @@ logger = logging.getLogger(__name__)
 # 初始化 RAG 所需的資源
 doc = "rule.txt"
 paragraphs = None
-embeddings = None
+retrieval_index = None
+lexical_index = None
+# 兩個索引對應的 rule.txt 版本；檔案內容改變時在下次取用時重建
+_paragraph_version = None
+_retrieval_version = None
+_paragraph_lock = threading.Lock()
+_index_lock = threading.Lock()
+
+# 檢索方式：
+#   vector：一律用問題 embedding 做向量檢索
+#   lexical_first：問題點名規則中的物品時直接用字詞索引的結果，略過 embedding；其餘走向量檢索
+#   hybrid：同 lexical_first，但退回向量檢索時再與 BM25 排名融合
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "lexical_first")
+# hybrid 模式下兩種排名各取的候選數
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "10"))
 
 logger.info("✅ 已進入 rag_v1.py 檔案")
 
-def get_embeddings():
-    global paragraphs, embeddings
-    if paragraphs is None or embeddings is None:
-        paragraphs = parse_paragraph(doc)
-        embeddings = cache_embeddings(doc, paragraphs)
-    return paragraphs, embeddings
+def _current_paragraphs():
+    """回傳 (版本, 段落, 字詞索引)；rule.txt 改變時重新分段並重建字詞索引"""
+    global paragraphs, lexical_index, _paragraph_version
+    with _paragraph_lock:
+        version = file_version(doc)
+        if version != _paragraph_version:
+            paragraphs = parse_paragraph(doc)
+            lexical_index = LexicalIndex(paragraphs)
+            _paragraph_version = version
+            logger.info(f"📖 規則已載入：{len(paragraphs)} 段，{len(lexical_index.item_names)} 個物品名稱")
+        return _paragraph_version, paragraphs, lexical_index
+
+def get_lexical_index():
+    return _current_paragraphs()[2]
+
+def get_retrieval_index():
+    """回傳規則的向量檢索索引；啟動預熱與第一個請求同時呼叫時只建一次，後到的等前者建好"""
+    global retrieval_index, _retrieval_version
+    version, current, _ = _current_paragraphs()
+    if retrieval_index is None or _retrieval_version != version:
+        with _index_lock:
+            if retrieval_index is None or _retrieval_version != version:
+                # 內容定址的 embedding 快取只會重算改動過的段落
+                retrieval_index = RetrievalIndex.build(current)
+                _retrieval_version = version
+    return retrieval_index
 
 api_key = os.getenv("GOOGLE_API_KEY")
 
-def handle_chat_request(prompt, conversation_history, enable_self_check=True):
-    """處理聊天請求，包含 RAG 和自我檢查邏輯"""
+# 生成前的分類、embedding、摘要三個 LLM 呼叫互不相依，改為並行執行
+# 各階段逾時秒數（從送出時起算）；分類或摘要逾時就略過，embedding 逾時則回報錯誤
+CLASSIFY_TIMEOUT = float(os.getenv("CHAT_CLASSIFY_TIMEOUT", "20"))
+EMBED_TIMEOUT = float(os.getenv("CHAT_EMBED_TIMEOUT", "30"))
+SUMMARY_TIMEOUT = float(os.getenv("CHAT_SUMMARY_TIMEOUT", "20"))
+_prestage_pool = ThreadPoolExecutor(max_workers=int(os.getenv("CHAT_PRESTAGE_WORKERS", "12")), thread_name_prefix="chat-prestage")
+
+def _wait_stage(future, started, timeout, stage, default):
+    """等待並行階段的結果；逾時回傳 default（背景呼叫仍會跑完，但不再等它）"""
+    remaining = max(0.0, started + timeout - time.monotonic())
     try:
-        paragraphs, embeddings = get_embeddings()
-        question_type = classify_question_type(prompt)
-        logger.info(f"🧠 問題分類結果：{question_type}")
+        return future.result(timeout=remaining)
+    except FutureTimeoutError:
+        logger.warning(f"⏱️ {stage} 超過 {timeout} 秒，略過此階段")
+        return default
+
+def _chat_completion(messages, attempt, stream):
+    """呼叫 LLM 生成回覆；stream=True 時逐段產生 token 事件，最後回傳完整內容"""
+    if not stream:
+        return llm_chat("generate", messages)
+    parts = []
+    for piece in llm_chat_stream("generate", messages):
+        if piece:
+            parts.append(piece)
+            yield "token", {"attempt": attempt, "content": piece}
+    return "".join(parts)
+
+def _context_key(prompt, conversation_history, chat_id):
+    """
+    回答快取的上下文指紋：本次提問之前、會放進 prompt 的最近對話，
+    加上略過較舊訊息時代替它們的 session 摘要（沒有摘要時改用被略過的訊息本身）。
+    沒有任何上下文時回傳空字串，這種問題才跨 session 共用答案。
+    """
+    recent_turns, dropped = select_recent_turns(conversation_history)
+    if recent_turns and recent_turns[-1].get("role") == "user" and recent_turns[-1].get("content") == prompt:
+        recent_turns = recent_turns[:-1]
+    older = []
+    if dropped:
+        summary = session_summaries.peek(chat_id)
+        older = [summary] if summary else [[m.get("role"), m.get("content", "")] for m in conversation_history[:dropped]]
+    if not recent_turns and not older:
+        return ""
+    raw = json.dumps([[m.get("role"), m.get("content", "")] for m in recent_turns] + older, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+def _final(reply, confirmed):
+    return "final", {"reply": reply, "confirmed": confirmed}
+
+def iter_chat_events(prompt, conversation_history, enable_self_check=True, stream=False, chat_id=None):
+    """
+    聊天流程的事件產生器，handle_chat_request 與 SSE 串流共用。
+    chat_id 用來維護該 session 的滾動摘要。
+    事件：token（串流模式下生成中的片段）、retract（該次回覆未通過自我檢查，應撤回）、final（最終回覆）。
+    """
+    # 整個請求的耗時依結果（cache、canned、exemplar、confirmed、unconfirmed、overloaded）與問題分類記錄
+    started = time.monotonic()
+    trace = {"outcome": "unconfirmed", "question_type": ""}
+    try:
+        # 同一題在規則未變動時直接回傳已通過自我檢查的答案
+        # 有對話脈絡的問題以脈絡指紋區分，「那要怎麼用」不會拿到別的對話的答案
+        rule_version = file_version(doc)
+        context_key = _context_key(prompt, conversation_history, chat_id)
+        cached = answer_cache.lookup(prompt, rule_version, context_key)
+        if cached is not None:
+            logger.info(f"💾 命中回答快取（{cached['question_type']}）")
+            trace.update(outcome="cache", question_type=cached["question_type"])
+            yield _final(cached["answer"], True)
+            return
+
+        # 打招呼、道謝與明顯無關的問題由本地規則直接回覆固定內容
+        local_intent = local_classify_question(prompt)
+        if local_intent is not None:
+            question_type, reply = canned_reply(local_intent)
+            logger.info(f"⚡ 本地分類：{local_intent}，直接回覆固定內容")
+            trace.update(outcome="canned", question_type=question_type)
+            yield _final(reply, True)
+            return
 
+        # 需要呼叫 Ollama 的請求先取得全域名額；排隊逾時或佇列已滿時丟出 Overloaded，由 app 回 503
+        with ollama_gate.slot():
+            for event, data in _llm_chat_events(prompt, conversation_history, enable_self_check, stream, chat_id, rule_version, context_key, trace):
+                if event == "final" and data["confirmed"] and trace["outcome"] != "exemplar":
+                    trace["outcome"] = "confirmed"
+                yield event, data
+    except Overloaded:
+        trace["outcome"] = "overloaded"
+        raise
+    except Exception as e:
+        logger.error(f"❌ handle_chat_request 發生未預期錯誤: {e}")
+        yield _final(f"handle_chat_request 發生未預期錯誤: {e}", False)
+    finally:
+        CHAT_REQUEST_SECONDS.observe(time.monotonic() - started, **trace)
+
+def _llm_chat_events(prompt, conversation_history, enable_self_check, stream, chat_id, rule_version, context_key, trace):
+    """iter_chat_events 取得 Ollama 名額後的流程：分類、檢索、生成與自我檢查；trace 回填結果與問題分類"""
+    # 問題直接點名規則中的物品時，字詞索引就能找到段落，不必送出 embedding
+    lexical = get_lexical_index()
+    lexical_hits = lexical.lookup(prompt, k=3) if RETRIEVAL_MODE != "vector" else None
+
+    # 本地規則已判斷不了：分類、embedding、摘要同時送出，在組 prompt 前匯合
+    started = time.monotonic()
+    classify_future = _prestage_pool.submit(classify_question_type, prompt)
+    observe_future("classify", classify_future, started)
+    embed_future = None
+    if lexical_hits is None:
+        # embedding 直接交給微批次排程，與其他同時進來的問題合併送出
+        embed_future = embedding_scheduler.submit(prompt)
+        observe_future("embed", embed_future, started)
+    summary_future = None
+    if len(conversation_history) >= 2:
+        # 對話未超過 token 預算時不會呼叫 LLM
+        summary_future = _prestage_pool.submit(session_summaries.summary_for, chat_id, conversation_history)
+        observe_future("summary", summary_future, started)
+
+    prompt_embedding = None
+    if embed_future is not None:
         try:
-            prompt_embedding = ollama.embeddings(model="ycchen/breeze-7b-instruct-v1_0", prompt=prompt)["embedding"]
+            prompt_embedding = _wait_stage(embed_future, started, EMBED_TIMEOUT, "LLM embeddings", None)
+            if prompt_embedding is None:
+                raise TimeoutError(f"超過 {EMBED_TIMEOUT} 秒")
         except Exception as e:
             logger.error(f"❌ LLM embeddings 發生錯誤: {e}")
-            return f"LLM embeddings 發生錯誤: {e}"
+            yield _final(f"LLM embeddings 發生錯誤: {e}", False)
+            return
 
+        # 規則無法判斷時，用已算好的問題 embedding 比對意圖範例句；有把握就不必等 LLM 分類
+        # 同一份 embedding 與意圖庫只做一次內積，分類與路線判斷共用
         try:
-            similar_vectors = calc_similar_vectors(prompt_embedding, embeddings)[:3]
-            valid_vectors = [v for v in similar_vectors if v[0] < len(paragraphs)]
-
-            memory_summary = None
-            if len(conversation_history) >= 2:
-                memory_summary = summarize_conversation(conversation_history[-4:])
-
-            system_prompt = build_instance_adaptive_prompt(paragraphs, valid_vectors, question_type, memory_summary)
-            messages = [{"role": "system", "content": system_prompt}] + conversation_history
-
-            if enable_self_check:
-                max_attempts = 3
-                attempt = 1
-                final_response = None
-                error_feedback = None
-                while attempt <= max_attempts:
-                    if error_feedback:
-                        retry_hint = f"上次回覆被判定為不合格，原因是：{error_feedback.strip()}。\n請遵守規則，請勿再犯下同樣的錯誤。\n\n"
-                    else:
-                        retry_hint = ""
-                    modified_system_prompt = retry_hint + system_prompt
-                    current_messages = [{"role": "system", "content": modified_system_prompt}] + conversation_history
-                    try:
-                        response = ollama.chat(model="ycchen/breeze-7b-instruct-v1_0", messages=current_messages)["message"]["content"]
-                    except Exception as e:
-                        logger.error(f"❌ LLM chat 發生錯誤: {e}")
-                        return f"LLM chat 發生錯誤: {e}"
+            intent_scores = intent_bank.scores(prompt_embedding)
+            exemplar_intent = classify_by_exemplars(scores=intent_scores)
+            if detect_route_intent(prompt, scores=intent_scores):
+                logger.info("🗺️ 玩家提到路線規劃")
+        except Exception as e:
+            logger.warning(f"⚠️ 意圖範例比對失敗，略過：{e}")
+            exemplar_intent = None
+        if exemplar_intent is not None:
+            # 範例句已判斷出固定回覆，尚未開始的分類直接取消，已在執行的結果不再使用
+            classify_future.cancel()
+            if summary_future is not None:
+                summary_future.cancel()
+            question_type, reply = canned_reply(exemplar_intent)
+            logger.info(f"⚡ 範例句分類：{exemplar_intent}，直接回覆固定內容")
+            trace.update(outcome="exemplar", question_type=question_type)
+            yield _final(reply, True)
+            return
 
-                    logger.info(f"\n🗨️ 回覆內容（第 {attempt} 次嘗試）:\n{response}\n")
+    try:
+        question_type = _wait_stage(classify_future, started, CLASSIFY_TIMEOUT, "問題分類", "other")
+    except Exception as e:
+        logger.warning(f"⚠️ 問題分類失敗，改用 other：{e}")
+        question_type = "other"
+    logger.info(f"🧠 問題分類結果：{question_type}")
+    trace["question_type"] = question_type
 
-                    # 呼叫 get_self_check_prompt
-                    check_response_prompt = get_self_check_prompt(question_type, response)
-                    try:
-                        audit_result = ollama.chat(
-                            model="ycchen/breeze-7b-instruct-v1_0",
-                            messages=[{"role": "user", "content": check_response_prompt}]
-                        )["message"]["content"]
-                    except Exception as e:
-                        logger.error(f"❌ LLM 自我檢查 chat 發生錯誤: {e}")
-                        return f"LLM 自我檢查 chat 發生錯誤: {e}"
-
-                    logger.info(f"🧪 自我檢查結果：{audit_result.strip()}\n")
-
-                    if "不合格" in audit_result:
-                        logger.warning("❌ 不合格，重新生成新的回答...")
-                        error_feedback = audit_result.replace("不合格：", "").strip()
-                        attempt += 1
-                    else:
-                        final_response = response
-                        break
-
-                if final_response is None:
-                    logger.warning("[⚠️ 最多重試次數已達，回答我不清楚遊戲以外的內容]")
-                    final_response = "我不清楚遊戲以外的內容"
-                return final_response
+    try:
+        # 回傳的是段落編號（長段落切成多個片段也會對回原段落）
+        with CHAT_STAGE_SECONDS.time(stage="retrieve", question_type=question_type):
+            if lexical_hits is not None:
+                logger.info(f"🔤 問題點名規則物品，以字詞索引取得 {len(lexical_hits)} 段規則，略過 embedding")
+                paragraphs = lexical.paragraphs
+                valid_vectors = lexical_hits
+            else:
+                index = get_retrieval_index()
+                paragraphs = index.paragraphs
+                if RETRIEVAL_MODE == "hybrid" and paragraphs is lexical.paragraphs:
+                    valid_vectors = rank_fusion([
+                        index.search(prompt_embedding, k=HYBRID_CANDIDATES),
+                        lexical.search(prompt, k=HYBRID_CANDIDATES),
+                    ], k=3)
+                else:
+                    valid_vectors = index.search(prompt_embedding, k=3)
+
+        # 指示與規則段落構成固定前綴；對話只保留預算內的最近幾則，較舊的由摘要代替
+        system_prompt = build_instance_adaptive_prompt(paragraphs, valid_vectors, question_type)
+        rule_paragraphs = [paragraphs[v[0]] for v in valid_vectors]
+        recent_turns, dropped = select_recent_turns(conversation_history)
+        memory_summary = None
+        if summary_future is not None:
+            if not dropped:
+                # 歷史全部放得下時摘要只是重複的內容，不必等它
+                summary_future.cancel()
             else:
                 try:
-                    response = ollama.chat(model="ycchen/breeze-7b-instruct-v1_0", messages=messages)["message"]["content"]
+                    memory_summary = _wait_stage(summary_future, started, SUMMARY_TIMEOUT, "對話摘要", None)
+                except Exception as e:
+                    logger.warning(f"⚠️ 對話摘要失敗，略過：{e}")
+        messages = assemble_chat_messages(system_prompt, recent_turns, memory_summary)
+        CHAT_PROMPT_TOKENS.observe(estimate_messages_tokens(messages), kind="sent")
+        CHAT_PROMPT_TOKENS.observe(
+            estimate_messages_tokens([{"role": "system", "content": system_prompt}] + conversation_history), kind="unbounded")
+        if dropped:
+            CHAT_HISTORY_DROPPED.inc(dropped)
+            logger.info(f"✂️ 對話歷史超過預算，略過較舊的 {dropped} 則訊息（{'以摘要代替' if memory_summary else '無摘要'}）")
+
+        if enable_self_check:
+            max_attempts = 3
+            attempt = 1
+            final_response = None
+            error_feedback = None
+            while attempt <= max_attempts:
+                if error_feedback:
+                    retry_hint = f"上次回覆被判定為不合格，原因是：{error_feedback.strip()}。\n請遵守規則，請勿再犯下同樣的錯誤。"
+                else:
+                    retry_hint = None
+                current_messages = assemble_chat_messages(system_prompt, recent_turns, memory_summary, retry_hint)
+                try:
+                    with CHAT_STAGE_SECONDS.time(stage="generate", question_type=question_type):
+                        response = yield from _chat_completion(current_messages, attempt, stream)
                 except Exception as e:
                     logger.error(f"❌ LLM chat 發生錯誤: {e}")
-                    return f"LLM chat 發生錯誤: {e}"
-                logger.info(f"\n🗨️ 回覆內容：\n{response}\n")
-                return response
-        except Exception as e:
-            logger.error(f"❌ handle_chat_request 內部流程錯誤: {e}")
-            return f"handle_chat_request 內部流程錯誤: {e}"
+                    yield _final(f"LLM chat 發生錯誤: {e}", False)
+                    return
+
+                logger.info(f"\n🗨️ 回覆內容（第 {attempt} 次嘗試）:\n{response}\n")
+
+                # 先以本地規則檢查（英文、簡體字、固定回覆、逐字引用），判斷不了才呼叫 LLM 稽核
+                with CHAT_STAGE_SECONDS.time(stage="self_check_local", question_type=question_type):
+                    verdict, reason = response_validator.validate(question_type, response, rule_paragraphs)
+                if verdict is not None:
+                    audit_result = "合格" if verdict else f"不合格：{reason}"
+                    audit_source = "local"
+                else:
+                    check_response_prompt = get_self_check_prompt(question_type, response)
+                    audit_source = "llm"
+                    try:
+                        with CHAT_STAGE_SECONDS.time(stage="self_check_llm", question_type=question_type):
+                            audit_result = llm_chat("audit", [{"role": "user", "content": check_response_prompt}])
+                    except Exception as e:
+                        logger.error(f"❌ LLM 自我檢查 chat 發生錯誤: {e}")
+                        yield _final(f"LLM 自我檢查 chat 發生錯誤: {e}", False)
+                        return
+
+                logger.info(f"🧪 自我檢查結果：{audit_result.strip()}\n")
+                SELF_CHECK_TOTAL.inc(
+                    source=audit_source, verdict="fail" if "不合格" in audit_result else "pass", question_type=question_type)
+
+                if "不合格" in audit_result:
+                    logger.warning("❌ 不合格，重新生成新的回答...")
+                    error_feedback = audit_result.replace("不合格：", "").strip()
+                    yield "retract", {"attempt": attempt, "reason": error_feedback}
+                    attempt += 1
+                else:
+                    final_response = response
+                    break
+
+            CHAT_ATTEMPTS.observe(min(attempt, max_attempts), question_type=question_type)
+            if final_response is None:
+                logger.warning("[⚠️ 最多重試次數已達，回答我不清楚遊戲以外的內容]")
+                yield _final("我不清楚遊戲以外的內容", False)
+                return
+            # 只快取通過自我檢查的答案
+            answer_cache.store(prompt, question_type, [v[0] for v in valid_vectors], final_response, rule_version, context_key)
+            yield _final(final_response, True)
+        else:
+            try:
+                with CHAT_STAGE_SECONDS.time(stage="generate", question_type=question_type):
+                    response = yield from _chat_completion(messages, 1, stream)
+            except Exception as e:
+                logger.error(f"❌ LLM chat 發生錯誤: {e}")
+                yield _final(f"LLM chat 發生錯誤: {e}", False)
+                return
+            logger.info(f"\n🗨️ 回覆內容：\n{response}\n")
+            yield _final(response, False)
     except Exception as e:
-        logger.error(f"❌ handle_chat_request 發生未預期錯誤: {e}")
-        return f"handle_chat_request 發生未預期錯誤: {e}"
+        logger.error(f"❌ handle_chat_request 內部流程錯誤: {e}")
+        yield _final(f"handle_chat_request 內部流程錯誤: {e}", False)
+
+def handle_chat_request(prompt, conversation_history, enable_self_check=True, chat_id=None):
+    """處理聊天請求，包含 RAG 和自我檢查邏輯"""
+    reply = None
+    for event, data in iter_chat_events(prompt, conversation_history, enable_self_check, chat_id=chat_id):
+        if event == "final":
+            reply = data["reply"]
+    return reply
 
-def handle_route_request(user_location, candidate_landmarks, enable_self_check=True,api_key=None):
-    """處理路線規劃請求"""
+def handle_route_request(user_location, candidate_landmarks, enable_self_check=True,api_key=None, stops=None):
+    """處理路線規劃請求；stops 可指定地點數（未指定時依難度決定）"""
     try:
         start_lat = user_location.get("latitude")
         start_lon = user_location.get("longitude")
 
-        if not all([start_lat, start_lon, api_key, candidate_landmarks]):
+        if not all([start_lat, start_lon, candidate_landmarks]) or (not api_key and routing_requires_api_key()):
             raise ValueError("缺少生成路線所需的參數（經緯度、API金鑰或候選地標）。")
 
         try:
-            response_data = generate_route_from_start(start_lat, start_lon, candidate_landmarks, api_key=api_key)
+            response_data = generate_route_from_start(start_lat, start_lon, candidate_landmarks, api_key=api_key, stops=stops)
             logger.info(f"\n🗺️ 路線規劃結果：\n{json.dumps(response_data, ensure_ascii=False, indent=2)}\n")
             return response_data
         except Exception as e:
@@ -0,0 +1,169 @@
+# route_planner.py
+# 任務路線規劃：地標兩兩之間的步行時間矩陣預先算好並快取，請求時只查「起點 → 各地標」一列，
+# 再以最近插入法 + 2-opt 挑出符合難度時間預算的 k 個地點。
+import os
+import time
+import random
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# 各難度的預設地點數與步行時間預算（秒）
+DIFFICULTY_PLANS = {
+    "easy": {"stops": 2, "budget": (300, 900)},
+    "normal": {"stops": 3, "budget": (600, 1500)},
+    "hard": {"stops": 4, "budget": (900, 2400)},
+}
+MAX_STOPS = 10
+# 每次規劃嘗試的隨機起始次數；越多越容易找到符合預算的路線
+PLANNER_RESTARTS = int(os.getenv("ROUTE_PLANNER_RESTARTS", "12"))
+# 最近插入時在成本最低的幾個候選中隨機挑選，讓每次任務不同
+PLANNER_RANDOM_TOP = 3
+# 最多保留幾組地標的距離矩陣（最久未用的先淘汰）
+MATRIX_CACHE_SIZE = int(os.getenv("ROUTE_MATRIX_CACHE_SIZE", "32"))
+# 含直線距離估算段（API 或路網暫時失敗）的矩陣只保留這麼久（秒），之後重新查詢
+MATRIX_FALLBACK_TTL = float(os.getenv("ROUTE_MATRIX_FALLBACK_TTL", "60"))
+
+class LandmarkMatrix:
+    """地標兩兩之間的步行距離（公尺）與時間（秒）"""
+
+    def __init__(self, landmarks, distances, durations):
+        self.landmarks = landmarks
+        self.distances = distances
+        self.durations = durations
+
+# 簽章 → (矩陣, 到期時間)；到期時間為 None 表示不過期
+_MATRICES = OrderedDict()
+_MATRIX_LOCK = threading.Lock()
+
+def _signature(landmarks):
+    return tuple(sorted((str(l["spotId"]), round(l["latitude"], 5), round(l["longitude"], 5)) for l in landmarks))
+
+def landmark_matrix(service, landmarks):
+    """
+    取得 landmarks 的距離矩陣；同一組地標只算一次。
+    步行距離視為對稱，只查上三角再鏡射，API 呼叫數減半；各段結果另由 DistanceService 持久快取。
+    含直線距離估算段的矩陣只快取 MATRIX_FALLBACK_TTL 秒，API 恢復後會改用實際路線重算。
+    """
+    signature = _signature(landmarks)
+    with _MATRIX_LOCK:
+        entry = _MATRICES.get(signature)
+        if entry is not None:
+            matrix, expires = entry
+            if expires is None or time.monotonic() < expires:
+                _MATRICES.move_to_end(signature)
+                return matrix
+            del _MATRICES[signature]
+    # 離線路網時先為每個地標建好最短路徑樹，之後各段直接查表
+    service.warm([(l["latitude"], l["longitude"]) for l in landmarks])
+    n = len(landmarks)
+    pairs, index = [], []
+    for i in range(n):
+        for j in range(i + 1, n):
+            a, b = landmarks[i], landmarks[j]
+            pairs.append((a["latitude"], a["longitude"], b["latitude"], b["longitude"]))
+            index.append((i, j))
+    distances = np.zeros((n, n), dtype=np.float64)
+    durations = np.zeros((n, n), dtype=np.float64)
+    results, estimated = service.batch_estimated(pairs)
+    for (i, j), (dist, dur) in zip(index, results):
+        distances[i, j] = distances[j, i] = dist
+        durations[i, j] = durations[j, i] = dur
+    matrix = LandmarkMatrix(list(landmarks), distances, durations)
+    expires = time.monotonic() + MATRIX_FALLBACK_TTL if estimated else None
+    with _MATRIX_LOCK:
+        _MATRICES[signature] = (matrix, expires)
+        _MATRICES.move_to_end(signature)
+        while len(_MATRICES) > MATRIX_CACHE_SIZE:
+            _MATRICES.popitem(last=False)
+    return matrix
+
+def _with_start(service, matrix, start_lat, start_lon):
+    """在矩陣前面加上起點（索引 0），只需查詢起點到各地標的一列"""
+    row = service.batch([(start_lat, start_lon, l["latitude"], l["longitude"]) for l in matrix.landmarks], snap_origin=True)
+    n = len(matrix.landmarks) + 1
+    distances = np.zeros((n, n), dtype=np.float64)
+    durations = np.zeros((n, n), dtype=np.float64)
+    distances[1:, 1:] = matrix.distances
+    durations[1:, 1:] = matrix.durations
+    distances[0, 1:] = distances[1:, 0] = [d for d, _ in row]
+    durations[0, 1:] = durations[1:, 0] = [t for _, t in row]
+    return distances, durations
+
+def path_cost(path, D):
+    return float(sum(D[path[i]][path[i + 1]] for i in range(len(path) - 1)))
+
+def _nearest_insertion(D, k, rng):
+    """從起點 0 出發的開放路徑：隨機選第一站，之後每次插入增加成本最少的地標（在前幾名中隨機挑）"""
+    n = len(D)
+    path = [0, rng.randrange(1, n)]
+    remaining = set(range(1, n)) - {path[1]}
+    while len(path) < k + 1:
+        options = []
+        for c in remaining:
+            # 插在最後
+            best_cost, best_pos = D[path[-1]][c], len(path)
+            for p in range(1, len(path)):
+                a, b = path[p - 1], path[p]
+                cost = D[a][c] + D[c][b] - D[a][b]
+                if cost < best_cost:
+                    best_cost, best_pos = cost, p
+            options.append((best_cost, c, best_pos))
+        options.sort()
+        _, c, pos = rng.choice(options[:PLANNER_RANDOM_TOP])
+        path.insert(pos, c)
+        remaining.discard(c)
+    return path
+
+def _two_opt(path, D):
+    """
+    起點固定、終點不固定的 2-opt：反轉區段直到無法再縮短。
+    矩陣為對稱，反轉區段內部成本不變，只需比較兩端接點的差值。
+    """
+    path = list(path)
+    n = len(path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            for j in range(i + 1, n):
+                a, b, c = path[i - 1], path[i], path[j]
+                delta = D[a][c] - D[a][b]
+                if j + 1 < n:
+                    d = path[j + 1]
+                    delta += D[b][d] - D[c][d]
+                if delta < -1e-9:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    improved = True
+    return path, path_cost(path, D)
+
+def plan_stops(D, k, budget, rng=None, restarts=PLANNER_RESTARTS):
+    """
+    在時間矩陣 D（索引 0 為起點）上挑 k 個地點並排序。
+    回傳 (path, duration)，path 不含起點；優先從符合 budget=(最短, 最長) 的路線中隨機挑一條，
+    都不符合時取最接近預算的一條。
+    """
+    rng = rng or random.Random()
+    # 小矩陣逐格存取時 list 比 numpy 索引快得多
+    D = np.asarray(D).tolist()
+    k = min(k, len(D) - 1)
+    low, high = budget
+    candidates = {}
+    for _ in range(restarts):
+        path, cost = _two_opt(_nearest_insertion(D, k, rng), D)
+        candidates[tuple(path)] = cost
+    feasible = [(p, c) for p, c in candidates.items() if low <= c <= high]
+    if feasible:
+        path, cost = rng.choice(feasible)
+    else:
+        path, cost = min(candidates.items(), key=lambda pc: max(low - pc[1], pc[1] - high))
+    return list(path[1:]), cost
+
+def plan_route(service, start_lat, start_lon, landmarks, stops, budget, rng=None):
+    """回傳 (依序的地標, 各段 (distance, duration))"""
+    matrix = landmark_matrix(service, landmarks)
+    distances, durations = _with_start(service, matrix, start_lat, start_lon)
+    order, _ = plan_stops(durations, stops, budget, rng)
+    path = [0] + order
+    legs = [(int(distances[a, b]), int(durations[a, b])) for a, b in zip(path, path[1:])]
+    return [matrix.landmarks[i - 1] for i in order], legs
@@ -0,0 +1,112 @@
+# session_memory.py
+# 每個聊天 session 的滾動摘要：每輪只把新訊息併入上一輪的摘要，而不是每輪重新總結整段對話。
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from llm_utils import summarize_conversation, estimate_messages_tokens
+
+# 對話歷史估計超過這個 token 數才需要摘要，短對話直接略過
+CHAT_SUMMARY_TOKEN_BUDGET = int(os.getenv("CHAT_SUMMARY_TOKEN_BUDGET", "400"))
+CHAT_SUMMARY_MAX_SESSIONS = int(os.getenv("CHAT_SUMMARY_MAX_SESSIONS", "2048"))
+# 設定後把摘要存到 SQLite，重啟或多個 worker 之間也能共用
+CHAT_SUMMARY_DB = os.getenv("CHAT_SUMMARY_DB", "")
+
+def _fingerprint(message):
+    raw = f'{message.get("role")}\0{message.get("content", "")}'
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+class SQLiteSummaryBackend:
+    """以 SQLite 保存 session 摘要的後端"""
+
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS summaries (chat_id TEXT PRIMARY KEY, state TEXT)")
+
+    def get(self, chat_id):
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute("SELECT state FROM summaries WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, chat_id, state):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?)", (chat_id, json.dumps(state, ensure_ascii=False)))
+
+    def delete(self, chat_id):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("DELETE FROM summaries WHERE chat_id = ?", (chat_id,))
+
+class SessionSummaryStore:
+    """
+    有上限的 LRU 記憶體快取，可選擇性搭配持久化後端（需提供 get/put/delete）。
+    每個 session 保存 {"summary": 摘要, "last": 最後一則已併入訊息的指紋}。
+    """
+
+    def __init__(self, max_sessions=CHAT_SUMMARY_MAX_SESSIONS, backend=None, token_budget=CHAT_SUMMARY_TOKEN_BUDGET):
+        self.max_sessions = max_sessions
+        self.backend = backend
+        self.token_budget = token_budget
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, chat_id):
+        with self._lock:
+            state = self._sessions.get(chat_id)
+            if state is not None:
+                self._sessions.move_to_end(chat_id)
+                return state
+        return self.backend.get(chat_id) if self.backend else None
+
+    def _put(self, chat_id, state):
+        with self._lock:
+            self._sessions[chat_id] = state
+            self._sessions.move_to_end(chat_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        if self.backend:
+            self.backend.put(chat_id, state)
+
+    def peek(self, chat_id):
+        """回傳目前保存的摘要，不呼叫 LLM；沒有時回傳 None"""
+        if not chat_id:
+            return None
+        state = self._get(chat_id)
+        return state["summary"] if state else None
+
+    def reset(self, chat_id):
+        with self._lock:
+            self._sessions.pop(chat_id, None)
+        if self.backend:
+            self.backend.delete(chat_id)
+
+    def summary_for(self, chat_id, conversation_history):
+        """
+        回傳目前 session 的摘要；對話未超過 token 預算時回傳 None 且不呼叫 LLM。
+        沒有 chat_id 時退回舊做法：直接總結最近四則訊息。
+        """
+        if estimate_messages_tokens(conversation_history) <= self.token_budget:
+            return None
+        if not chat_id:
+            return summarize_conversation(conversation_history[-4:])
+
+        state = self._get(chat_id)
+        new_messages = conversation_history
+        previous = None
+        if state is not None:
+            # 從最後面找到上次併入的訊息，只併入之後的新訊息（Node 端會把歷史截到最近 10 則，所以不能用索引）
+            # 找不到代表歷史已被清空重來，舊摘要作廢
+            for i in range(len(conversation_history) - 1, -1, -1):
+                if _fingerprint(conversation_history[i]) == state["last"]:
+                    new_messages = conversation_history[i + 1:]
+                    previous = state["summary"]
+                    break
+        if not new_messages:
+            return previous
+        summary = summarize_conversation(new_messages, previous_summary=previous)
+        self._put(chat_id, {"summary": summary, "last": _fingerprint(conversation_history[-1])})
+        return summary
+
+session_summaries = SessionSummaryStore(backend=SQLiteSummaryBackend(CHAT_SUMMARY_DB) if CHAT_SUMMARY_DB else None)
@@ -0,0 +1,15 @@
+# tests/conftest.py
+# 測試一律使用行程內的 stub 後端（不需 Ollama），快取寫到暫存目錄；需在 import 服務模組前設定環境變數。
+import os
+import sys
+import tempfile
+
+_TMP = tempfile.mkdtemp(prefix="hunter-llm-tests-")
+os.environ.setdefault("LLM_BACKEND", "stub")
+os.environ.setdefault("EMBEDDING_CACHE_DIR", os.path.join(_TMP, "embeddings"))
+os.environ.setdefault("DISTANCE_CACHE_DB", os.path.join(_TMP, "distances.db"))
+os.environ.setdefault("WARMUP_ON_START", "0")
+os.environ.setdefault("FEATURE_DB_PATH", os.path.join(_TMP, "features", "train_features.db"))
+os.environ.setdefault("FEATURE_RELOAD_INTERVAL", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
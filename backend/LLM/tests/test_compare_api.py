@@ -0,0 +1,85 @@
+# tests/test_compare_api.py
+# 線上刪除特徵後的比對：整類刪光的類別不可參與比較，回傳內容必須是合法 JSON（不可有 -Infinity）。
+import os
+import json
+import numpy as np
+import pytest
+import compare_api
+from bench.features import write_feature_db
+
+DIM = 8
+
+
+@pytest.fixture
+def feature_db(monkeypatch):
+    """兩個類別、各 4 筆特徵的資料庫；每個測試重新載入快取"""
+    rng = np.random.default_rng(0)
+    centers = {"海大校門": np.eye(DIM)[0], "圖書館": np.eye(DIM)[1]}
+    labels = [label for label in centers for _ in range(4)]
+    F = np.stack([centers[label] + rng.normal(0, 0.05, DIM) for label in labels]).astype(np.float32)
+    os.makedirs(os.path.dirname(compare_api.FEATURE_DB_PATH), exist_ok=True)
+    write_feature_db(compare_api.FEATURE_DB_PATH, F, labels)
+    monkeypatch.setattr(compare_api, "_DB_CACHE", None)
+    compare_api.ensure_cache()
+    return centers
+
+
+def _row_ids(label):
+    cache = compare_api.ensure_cache()
+    c = cache["class_names"].index(label)
+    bounds = list(cache["class_starts"]) + [cache["features_norm"].shape[0]]
+    return [int(i) for i in cache["row_ids"][bounds[c]:bounds[c + 1]]]
+
+
+@pytest.mark.parametrize("mode", ["brute", "prototype"])
+def test_deleted_class_is_not_predicted(feature_db, monkeypatch, mode):
+    monkeypatch.setattr(compare_api, "FEATURE_INDEX_MODE", mode)
+    monkeypatch.setattr(compare_api, "FEATURE_INDEX_SHORTLIST", 1)
+    compare_api.warm_index()
+    for row_id in _row_ids("海大校門"):
+        assert compare_api.remove_feature(row_id)
+
+    result = compare_api.compare_vector("海大校門", feature_db["海大校門"].tolist())
+
+    assert result["predicted"] != "海大校門"
+    assert np.isfinite(result["score"])
+    json.dumps(result, allow_nan=False)
+
+
+def test_prototypes_skip_deleted_rows(feature_db):
+    compare_api._ensure_prototypes(compare_api.ensure_cache(), 2)
+    for row_id in _row_ids("海大校門"):
+        compare_api.remove_feature(row_id)
+
+    cache = compare_api.ensure_cache()
+    dead = cache["prototypes"][2]["dead"]
+
+    assert dead.tolist() == [name == "海大校門" for name in cache["class_names"]]
+
+
+def test_all_rows_deleted_returns_empty_result(feature_db):
+    for label in feature_db:
+        for row_id in _row_ids(label):
+            compare_api.remove_feature(row_id)
+
+    result = compare_api.compare_vector("圖書館", feature_db["圖書館"].tolist())
+
+    assert result == compare_api._EMPTY_RESULT
+
+
+def test_reload_keeps_the_replaced_snapshot_until_next_reload(feature_db):
+    first = compare_api.ensure_cache()["snapshot"]
+
+    def stems():
+        return {name.split(".")[0] for name in os.listdir(compare_api.FEATURE_SNAPSHOT_DIR) if not name.endswith(".tmp")}
+
+    compare_api.add_feature("圖書館", feature_db["圖書館"].tolist())
+    compare_api.reload_cache(force=True)
+    second = compare_api.ensure_cache()["snapshot"]
+    assert second != first
+    assert {os.path.basename(compare_api._snapshot_stem(s)) for s in (first, second)} <= stems()
+
+    compare_api.remove_feature(_row_ids("圖書館")[0])
+    compare_api.reload_cache(force=True)
+    assert os.path.basename(compare_api._snapshot_stem(first)) not in stems()
+    assert os.path.basename(compare_api._snapshot_stem(second)) in stems()
@@ -0,0 +1,51 @@
+# tests/test_distance_service.py
+# 離線路網查詢的計數：distance_stats 與 hunter_distance_local 指標依賴這些數字。
+import distance_service
+from distance_service import DistanceService
+from walking_graph import RoutingUnavailable
+
+
+class FakeGraph:
+    """固定回傳距離的路網；unreachable 內的終點視為不連通"""
+
+    def __init__(self, unreachable=()):
+        self.unreachable = set(unreachable)
+
+    def route(self, lat1, lon1, lat2, lon2):
+        if (lat2, lon2) in self.unreachable:
+            raise RoutingUnavailable("兩點之間沒有相連的步道")
+        return 120, 92
+
+    def warm(self, points):
+        pass
+
+
+def test_local_legs_are_counted():
+    service = DistanceService(cache_db=None, graph=FakeGraph(), backend="local")
+    assert service.leg(25.15, 121.77, 25.151, 121.772) == (120, 92)
+    service.batch([(25.15, 121.77, 25.152, 121.773)] * 3)
+    assert service.stats["local"] == 4
+    assert service.stats["fallbacks"] == 0
+
+
+def test_unreachable_local_leg_counts_as_fallback():
+    service = DistanceService(cache_db=None, graph=FakeGraph(unreachable=[(25.16, 121.78)]), backend="local")
+    results, estimated = service.batch_estimated([(25.15, 121.77, 25.16, 121.78), (25.15, 121.77, 25.151, 121.772)])
+    assert estimated == 1
+    assert results[1] == (120, 92)
+    assert service.stats["local"] == 1
+    assert service.stats["fallbacks"] == 1
+
+
+def test_local_first_without_api_key_estimates_unreachable_legs():
+    service = DistanceService(None, cache_db=None, graph=FakeGraph(unreachable=[(25.16, 121.78)]), backend="local_first")
+    results, estimated = service.batch_estimated([(25.15, 121.77, 25.16, 121.78), (25.15, 121.77, 25.151, 121.772)])
+    assert estimated == 1
+    assert results[1] == (120, 92)
+    assert service.stats["fallbacks"] == 1
+
+
+def test_local_first_does_not_require_api_key(monkeypatch):
+    for backend, required in (("google", True), ("local", False), ("local_first", False)):
+        monkeypatch.setattr(distance_service, "ROUTING_BACKEND", backend)
+        assert distance_service.routing_requires_api_key() is required
@@ -0,0 +1,43 @@
+# tests/test_response_validator.py
+# 固定回覆範本必須在本地驗證就判定合格，不可再送 LLM 稽核。
+#
+# 用法（在 backend/LLM 下執行）：
+#   python -m pytest tests
+import pytest
+import rag_v1
+from llm_client import llm_client, StubBackend
+from llm_utils import ResponseValidator, CANNED_REPLIES, _EXACT_TEMPLATES
+
+
+@pytest.mark.parametrize("question_type, reply", [
+    (question_type, template) for question_type, templates in _EXACT_TEMPLATES.items() for template in templates
+] + [("off_topic", CANNED_REPLIES["off_topic"]), ("off_topic", CANNED_REPLIES["language"])])
+def test_exact_template_passes_locally(question_type, reply):
+    assert ResponseValidator().validate(question_type, reply) == (True, None)
+
+
+def test_template_with_extra_text_fails_locally():
+    verdict, reason = ResponseValidator().validate("greeting", CANNED_REPLIES["greeting"] + "，今天想找哪個寶箱呢")
+    assert verdict is False and reason
+
+
+def test_verbatim_template_skips_llm_audit(monkeypatch):
+    # 本地規則判斷不了的問題交給 LLM 分類為打招呼，生成結果逐字等於範本
+    backend = StubBackend(replies={"classify": "1. 打招呼", "generate": CANNED_REPLIES["greeting"]})
+    monkeypatch.setattr(llm_client, "backend", backend)
+    monkeypatch.setattr(rag_v1, "classify_by_exemplars", lambda **kwargs: None)
+
+    answer = rag_v1.handle_chat_request("關主在嗎", [], True, "validator-test")
+
+    assert answer == CANNED_REPLIES["greeting"]
+    roles = [role for role, _ in backend.calls]
+    assert "generate" in roles
+    assert "audit" not in roles
+
+
+def test_refusal_with_retrieved_rules_defers_to_audit():
+    paragraphs = ["（物件）銅鑰匙可以打開銅寶箱"]
+    validator = ResponseValidator()
+    assert validator.validate("rule_query", CANNED_REPLIES["off_topic"], paragraphs) == (None, None)
+    assert validator.validate("rule_query", CANNED_REPLIES["off_topic"]) == (True, None)
+    assert validator.validate("off_topic", CANNED_REPLIES["off_topic"], paragraphs) == (True, None)
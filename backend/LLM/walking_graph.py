@@ -0,0 +1,206 @@
+# walking_graph.py
+# 離線的校園步行路網：由 GeoJSON 或 OSM 檔載入步道，座標以格網索引對齊最近節點，
+# 以 A* 求最短路徑，並對地標快取整棵最短路徑樹，回傳與 Google Directions 相同的 (distance_meters, duration_seconds)。
+import os
+import json
+import heapq
+import math
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, defaultdict
+
+logger = logging.getLogger(__name__)
+
+CAMPUS_GRAPH_PATH = os.getenv("CAMPUS_GRAPH_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "campus_paths.geojson"))
+# 座標離最近節點超過此距離（公尺）視為不在路網上
+CAMPUS_SNAP_MAX_METERS = float(os.getenv("CAMPUS_SNAP_MAX_METERS", "300"))
+CAMPUS_TREE_CACHE = int(os.getenv("CAMPUS_TREE_CACHE", "256"))
+# 格網索引的格子大小（度），約 100 公尺
+_GRID_DEGREES = 0.001
+# OSM 中行人不能走的道路類型
+_NON_WALKABLE = {"motorway", "motorway_link", "trunk", "trunk_link"}
+
+# 直線距離估算用：校園步行路線約為直線距離的 1.3 倍，步行速度約每秒 1.3 公尺
+WALK_DETOUR_FACTOR = 1.3
+WALK_SPEED_MPS = 1.3
+
+def haversine_meters(lat1, lon1, lat2, lon2):
+    r = 6371000.0
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * r * math.asin(math.sqrt(a))
+
+class RoutingUnavailable(Exception):
+    """座標不在路網上或兩點之間不連通"""
+
+class WalkingGraph:
+    def __init__(self):
+        self.coords = []                 # 節點 id -> (lat, lon)
+        self.edges = defaultdict(list)   # 節點 id -> [(鄰居 id, 公尺)]
+        self._ids = {}                   # (lat, lon) -> 節點 id
+        self._grid = defaultdict(list)   # 格子 -> [節點 id]
+        self._trees = OrderedDict()      # 來源節點 -> {節點 id: 公尺}
+        self._lock = threading.Lock()
+
+    def _node(self, lat, lon):
+        key = (round(lat, 7), round(lon, 7))
+        node = self._ids.get(key)
+        if node is None:
+            node = self._ids[key] = len(self.coords)
+            self.coords.append(key)
+            self._grid[self._cell(*key)].append(node)
+        return node
+
+    @staticmethod
+    def _cell(lat, lon):
+        return int(math.floor(lat / _GRID_DEGREES)), int(math.floor(lon / _GRID_DEGREES))
+
+    def add_path(self, points):
+        """加入一條折線步道（[(lat, lon), ...]），雙向可走"""
+        nodes = [self._node(lat, lon) for lat, lon in points]
+        for a, b in zip(nodes, nodes[1:]):
+            if a == b:
+                continue
+            meters = haversine_meters(*self.coords[a], *self.coords[b])
+            self.edges[a].append((b, meters))
+            self.edges[b].append((a, meters))
+
+    @classmethod
+    def from_geojson(cls, path):
+        """讀取 LineString / MultiLineString 的 GeoJSON（座標為 [lon, lat]）"""
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        graph = cls()
+        for feature in data.get("features", []):
+            geometry = feature.get("geometry") or {}
+            if (feature.get("properties") or {}).get("foot") == "no":
+                continue
+            if geometry.get("type") == "LineString":
+                lines = [geometry["coordinates"]]
+            elif geometry.get("type") == "MultiLineString":
+                lines = geometry["coordinates"]
+            else:
+                continue
+            for line in lines:
+                graph.add_path([(lat, lon) for lon, lat, *_ in line])
+        return graph
+
+    @classmethod
+    def from_osm(cls, path):
+        """讀取 OSM XML 匯出檔中帶 highway 標籤的 way"""
+        root = ET.parse(path).getroot()
+        positions = {n.get("id"): (float(n.get("lat")), float(n.get("lon"))) for n in root.iter("node")}
+        graph = cls()
+        for way in root.iter("way"):
+            tags = {t.get("k"): t.get("v") for t in way.iter("tag")}
+            if "highway" not in tags or tags["highway"] in _NON_WALKABLE or tags.get("foot") == "no":
+                continue
+            points = [positions[nd.get("ref")] for nd in way.iter("nd") if nd.get("ref") in positions]
+            graph.add_path(points)
+        return graph
+
+    @classmethod
+    def load(cls, path=CAMPUS_GRAPH_PATH):
+        if path.endswith(".osm"):
+            graph = cls.from_osm(path)
+        else:
+            graph = cls.from_geojson(path)
+        logger.info(f"已載入校園路網 {path}：{len(graph.coords)} 個節點")
+        return graph
+
+    def nearest(self, lat, lon):
+        """回傳 (最近節點 id, 距離公尺)；由所在格子往外一圈一圈找"""
+        if not self.coords:
+            raise RoutingUnavailable("路網為空")
+        ci, cj = self._cell(lat, lon)
+        max_ring = int(CAMPUS_SNAP_MAX_METERS / 100) + 2
+        best, best_dist = None, float("inf")
+        for ring in range(max_ring + 1):
+            for i in range(ci - ring, ci + ring + 1):
+                for j in range(cj - ring, cj + ring + 1):
+                    if max(abs(i - ci), abs(j - cj)) != ring:
+                        continue
+                    for node in self._grid.get((i, j), ()):
+                        d = haversine_meters(lat, lon, *self.coords[node])
+                        if d < best_dist:
+                            best, best_dist = node, d
+            # 已找到的節點比下一圈的最近可能距離還近就可以停
+            if best is not None and best_dist <= ring * _GRID_DEGREES * 100000 * math.cos(math.radians(lat)):
+                break
+        if best is None or best_dist > CAMPUS_SNAP_MAX_METERS:
+            raise RoutingUnavailable(f"({lat}, {lon}) 不在校園路網上")
+        return best, best_dist
+
+    def _astar(self, source, target):
+        goal = self.coords[target]
+        h = lambda n: haversine_meters(*self.coords[n], *goal)
+        g = {source: 0.0}
+        heap = [(h(source), source)]
+        closed = set()
+        while heap:
+            _, node = heapq.heappop(heap)
+            if node == target:
+                return g[node]
+            if node in closed:
+                continue
+            closed.add(node)
+            for nxt, meters in self.edges[node]:
+                cost = g[node] + meters
+                if cost < g.get(nxt, float("inf")):
+                    g[nxt] = cost
+                    heapq.heappush(heap, (cost + h(nxt), nxt))
+        raise RoutingUnavailable("兩點之間沒有相連的步道")
+
+    def _dijkstra(self, source):
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        while heap:
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            for nxt, meters in self.edges[node]:
+                cost = d + meters
+                if cost < dist.get(nxt, float("inf")):
+                    dist[nxt] = cost
+                    heapq.heappush(heap, (cost, nxt))
+        return dist
+
+    def tree(self, source):
+        """取得（必要時計算）從 source 出發的最短路徑樹"""
+        with self._lock:
+            tree = self._trees.get(source)
+            if tree is not None:
+                self._trees.move_to_end(source)
+                return tree
+        tree = self._dijkstra(source)
+        with self._lock:
+            self._trees[source] = tree
+            while len(self._trees) > CAMPUS_TREE_CACHE:
+                self._trees.popitem(last=False)
+        return tree
+
+    def warm(self, points):
+        """預先為地標建立最短路徑樹；points 為 [(lat, lon), ...]"""
+        for lat, lon in points:
+            try:
+                self.tree(self.nearest(lat, lon)[0])
+            except RoutingUnavailable as e:
+                logger.warning(f"地標無法對齊路網：{e}")
+
+    def route(self, lat1, lon1, lat2, lon2):
+        """回傳 (distance_meters, duration_seconds)；任一端有快取的最短路徑樹時直接查表，否則跑 A*"""
+        a, offset_a = self.nearest(lat1, lon1)
+        b, offset_b = self.nearest(lat2, lon2)
+        with self._lock:
+            tree_a, tree_b = self._trees.get(a), self._trees.get(b)
+        if tree_b is not None or tree_a is not None:
+            meters = tree_b.get(a) if tree_b is not None else tree_a.get(b)
+            if meters is None:
+                raise RoutingUnavailable("兩點之間沒有相連的步道")
+        else:
+            meters = self._astar(a, b)
+        distance = meters + offset_a + offset_b
+        return int(round(distance)), int(round(distance / WALK_SPEED_MPS))
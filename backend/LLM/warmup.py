@@ -0,0 +1,86 @@
+# warmup.py
+# 啟動預熱：在背景載入或建立規則檢索索引、意圖範例句矩陣、特徵比對快取（含原型索引）與校園路網，
+# 並以 keep_alive 預載各角色用到的 Ollama 模型，讓第一個請求不必在請求內做這些事。
+# 失敗的項目每隔 WARMUP_RETRY_SECONDS 重試（例如 Ollama 比本服務晚啟動），/readyz 回報各項目狀態。
+import os
+import time
+import logging
+import threading
+import rag_v1
+from compare_api import ensure_cache, warm_index
+from distance_service import warm_routing
+from llm_client import llm_client
+from llm_utils import intent_bank
+
+logger = logging.getLogger(__name__)
+
+# app 載入時是否自動開始預熱（離線工具、單次腳本可設為 0）
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "1") == "1"
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "10"))
+
+# 依序執行；模型先載入，之後建立規則索引時的 embedding 呼叫就不用再等模型載入
+TASKS = (
+    ("features", ensure_cache),
+    # prototype 模式的類別原型（brute 模式時不做事）
+    ("prototypes", warm_index),
+    ("routing", lambda: warm_routing(os.getenv("GOOGLE_MAPS_API_KEY"))),
+    ("model", llm_client.preload),
+    ("rules", rag_v1.get_retrieval_index),
+    ("intents", intent_bank.warm),
+)
+
+class Warmup:
+    def __init__(self, tasks=TASKS, retry_seconds=WARMUP_RETRY_SECONDS):
+        self.tasks = tasks
+        self.retry_seconds = retry_seconds
+        self._state = {name: {"status": "pending"} for name, _ in tasks}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._done = threading.Event()
+
+    def _set(self, name, **state):
+        with self._lock:
+            self._state[name] = state
+
+    def _run_once(self):
+        """執行尚未完成的項目；回傳是否全部完成"""
+        for name, fn in self.tasks:
+            if self._state[name]["status"] == "ready":
+                continue
+            self._set(name, status="running")
+            started = time.perf_counter()
+            try:
+                fn()
+            except Exception as e:
+                logger.warning(f"⏳ 預熱 {name} 失敗：{e}")
+                self._set(name, status="failed", error=str(e))
+                continue
+            seconds = round(time.perf_counter() - started, 3)
+            logger.info(f"🔥 預熱 {name} 完成（{seconds} 秒）")
+            self._set(name, status="ready", seconds=seconds)
+        return self.ready()
+
+    def run(self):
+        while not self._run_once():
+            time.sleep(self.retry_seconds)
+        self._done.set()
+
+    def start(self):
+        """在背景執行緒開始預熱（重複呼叫不會重跑）"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+                self._thread.start()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def ready(self):
+        with self._lock:
+            return all(s["status"] == "ready" for s in self._state.values())
+
+    def status(self):
+        with self._lock:
+            return {name: dict(state) for name, state in self._state.items()}
+
+warmup = Warmup()
@@ -37,7 +37,9 @@ const chatWithLLM = async (req, res) => {
     let flaskRes;
     try {
       // timeout 設定拉長到 3600 秒
-      flaskRes = await axios.post(flaskUrl, { message, history: usedHistory }, { timeout: 3600000 });
+      // chatId 讓 Flask 端維護此對話的滾動摘要
+      const chatId = chat ? chat._id.toString() : userId;
+      flaskRes = await axios.post(flaskUrl, { message, history: usedHistory, chatId }, { timeout: 3600000 });
     } catch (flaskErr) {
       // 更詳細的錯誤日誌
       console.error("❌ Flask 連線或回傳錯誤：", flaskErr);
@@ -46,6 +48,13 @@ const chatWithLLM = async (req, res) => {
         console.error("❌ Flask 回傳狀態碼：", flaskErr.response.status);
         console.error("❌ Flask 回傳內容：", flaskErr.response.data);
       }
+      // LLM 服務忙碌（排隊已滿或等待逾時）：維持 503 並轉交 Retry-After，讓前端稍後重試
+      if (flaskErr.response && flaskErr.response.status === 503) {
+        const data = flaskErr.response.data || {};
+        const retryAfter = Number(flaskErr.response.headers['retry-after'] || data.retryAfter) || 1;
+        res.set('Retry-After', String(retryAfter));
+        return res.status(503).json({ error: "AI 服務忙碌中，請稍後再試。", retryAfter });
+      }
       if (flaskErr.response && flaskErr.response.data && flaskErr.response.data.error) {
         const flaskErrorMsg = flaskErr.response.data.error;
         console.error("❌ Flask 回傳錯誤內容：", flaskErrorMsg);